@@ -0,0 +1,141 @@
+"""Differential check and benchmark of library.FastCanonicalize.
+
+Every object of the corpus must canonicalize to the same bytes with both
+encoders, and whenever src.network.decode_message takes an object's raw
+bytes from the wire they must equal its canonical form, before anything is
+timed. Run from the repository root:
+
+    python -m bench.canonicalize
+"""
+import json
+import random
+import timeit
+
+from library.Canonicalize import canonicalize as slow_canonicalize
+from library.FastCanonicalize import canonicalize as fast_canonicalize
+from src.network import decode_message
+
+
+def marabu_corpus():
+    txid = 'b303d841891f91af118a319f99f5984def51091166ac73c062c98f86ea7371ee'
+    sig = '060bf7cbe141fecfebf6dafbd6ebbcff25f82e729a7770f4f3b1f81a7ec8a0ce' * 2
+    pubkey = '958f8add086cc348e229a3b6590c71b7d7754e42134a127a50648bf07969d9a0'
+    tx = {
+        'type': 'transaction',
+        'inputs': [{'outpoint': {'txid': txid, 'index': i}, 'sig': sig} for i in range(8)],
+        'outputs': [{'pubkey': pubkey, 'value': 10 * i} for i in range(4)]
+    }
+    block = {
+        'type': 'block',
+        'txids': [txid] * 20,
+        'nonce': 'a26d92800cf58e88a5ecf37156c031a4147c2128beeaf1cca2785c93242a4c8b',
+        'previd': None,
+        'created': 1624219079,
+        'T': '00000002af000000000000000000000000000000000000000000000000000000',
+        'miner': 'Penguin',
+        'note': 'The New York Times 2021-06-20: Penguins are cool'
+    }
+    coinbase = {'type': 'transaction', 'height': 1, 'outputs': [{'pubkey': pubkey, 'value': 50 * 10**9}]}
+    return [
+        tx, block, coinbase,
+        {'type': 'object', 'object': tx},
+        {'type': 'ihaveobject', 'objectid': txid},
+        {'type': 'hello', 'version': '0.6.1', 'agent': 'Penguin-Core 0.6.0'},
+        {'type': 'peers', 'peers': ['127.0.0.1:18018', 'keftes.di.uoa.gr:18018']},
+        {'type': 'mempool', 'txids': []},
+    ]
+
+
+def edge_corpus():
+    return [
+        0, -0, 1, -1, 2**53, -2**53, 2**53 + 1, 2**64, -2**70, 10**21,
+        0.0, -0.0, 1.0, 1.5, -2.25, 1e21, 1e-7, 5e-324, 1.7976931348623157e308,
+        True, False, None, '', 'abc', 'é', '\u20ac', '\U0001f600', '\x00\x1f\x7f', '"\\/\b\f\n\r\t',
+        [], {}, [[]], [{}], (1, 2), [1, (2, 3)],
+        {'b': 1, 'a': 2, 'A': 3, '_': 4, '10': 5, '9': 6},
+        {'\u20ac': 1, '\r': 2, '\U0001f600': 3, '\ufb33': 4, '1': 5, '\u0080': 6, 'ö': 7},
+        {'a': {'c': [1, {'e': None, 'd': 1.0}], 'b': 'x'}},
+        {1: 'int key'}, {True: 'bool key'}, {None: 'null key'},
+    ]
+
+
+def random_value(rng, depth=0):
+    kind = rng.randrange(9 if depth < 4 else 6)
+    if kind == 0:
+        return rng.randint(-2**60, 2**60)
+    if kind == 1:
+        return rng.randint(-1000, 1000)
+    if kind == 2:
+        return rng.choice([rng.random() * 10 ** rng.randint(-30, 30), float(rng.randint(-10**6, 10**6))])
+    if kind == 3:
+        return ''.join(chr(rng.choice([rng.randrange(0x20), rng.randrange(0x20, 0x7f), rng.randrange(0x80, 0x3000)]))
+                       for _ in range(rng.randrange(8)))
+    if kind == 4:
+        return rng.choice([True, False, None])
+    if kind == 5:
+        return '%064x' % rng.getrandbits(256)
+    if kind == 6:
+        return [random_value(rng, depth + 1) for _ in range(rng.randrange(5))]
+    keys = [random_value(rng, 4) if rng.random() < 0.3 else rng.choice('abcdefgh') for _ in range(rng.randrange(6))]
+    return {k if isinstance(k, str) else str(k): random_value(rng, depth + 1) for k in keys}
+
+
+def corpus():
+    rng = random.Random(18018)
+    return marabu_corpus() + edge_corpus() + [random_value(rng) for _ in range(5000)]
+
+
+def outcome(canonicalize, obj):
+    try:
+        return canonicalize(obj)
+    except (AttributeError, TypeError, ValueError) as error:
+        return type(error)
+
+
+def check():
+    objects = corpus()
+    for obj in objects:
+        (slow, fast) = (outcome(slow_canonicalize, obj), outcome(fast_canonicalize, obj))
+        if slow != fast:
+            raise AssertionError('Encoders disagree on %r:\n%r\n%r' % (obj, slow, fast))
+    print('%d objects canonicalized identically' % len(objects))
+
+    frames, reused = 0, 0
+    for obj in objects:
+        expected = outcome(slow_canonicalize, obj)
+        if not isinstance(expected, bytes):
+            continue
+        variants = [
+            expected,
+            json.dumps(obj).encode(),
+            json.dumps(obj, sort_keys=True, separators=(',', ':')).encode(),
+            json.dumps(obj, sort_keys=True, separators=(',', ':'), ensure_ascii=False).encode(),
+        ]
+        for variant in variants:
+            (_, raw) = decode_message(b'{"object":' + variant + b',"type":"object"}')
+            frames += 1
+            if raw is None:
+                continue
+            if raw != expected:
+                raise AssertionError('Non-canonical bytes %r taken as canonical for %r' % (raw, obj))
+            reused += 1
+    print('%d object frames decoded, raw bytes reused for %d' % (frames, reused))
+
+
+def bench():
+    for obj in marabu_corpus()[:3]:
+        slow = min(timeit.repeat(lambda: slow_canonicalize(obj), number=2000, repeat=3))
+        fast = min(timeit.repeat(lambda: fast_canonicalize(obj), number=2000, repeat=3))
+        print('%-14s canonicalize: slow %7.1f us  fast %6.1f us  (%.1fx)' % (
+            obj['type'] + ('/cb' if 'height' in obj else ''), slow / 2000 * 1e6, fast / 2000 * 1e6, slow / fast))
+
+        frame = b'{"object":' + slow_canonicalize(obj) + b',"type":"object"}'
+        reencode = min(timeit.repeat(lambda: fast_canonicalize(json.loads(frame)['object']), number=2000, repeat=3))
+        raw = min(timeit.repeat(lambda: decode_message(frame), number=2000, repeat=3))
+        print('%-14s decode: re-encode %6.1f us  raw span %6.1f us  (%.1fx)' % (
+            '', reencode / 2000 * 1e6, raw / 2000 * 1e6, reencode / raw))
+
+
+if __name__ == '__main__':
+    check()
+    bench()
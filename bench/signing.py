@@ -0,0 +1,95 @@
+"""Benchmark of transaction signature checking on many-input transactions.
+
+Compares the per-input database lookup, deepcopy, canonicalize and hex
+verification that Transaction.check_inputs used to do with the current
+implementation, which reads outputs from the UTXO set and builds the signing
+message once, verifying inline and on thread and process pools. Run from the
+repository root:
+
+    python -m bench.signing
+"""
+import copy
+import os
+import tempfile
+import timeit
+
+from nacl.encoding import HexEncoder
+from nacl.signing import SigningKey, VerifyKey
+
+from library.FastCanonicalize import canonicalize
+from src.blockchain import Envelope, Transaction
+from src.utxo import UTxOSet
+from src.verify import SignatureVerifier
+
+SEED = b'abcdefghijklmnopqrstuvwxyz012345'
+
+
+class MemoryDB:
+    def __init__(self):
+        self.objects = {}
+
+    def get(self, key):
+        return self.objects.get(key, False)
+
+    def keys(self):
+        return list(self.objects)
+
+
+def make_utxos(db):
+    return UTxOSet(db, os.path.join(tempfile.mkdtemp(), 'bench.utxo'))
+
+
+def make_transaction(db, utxos, key, inputs):
+    pubkey = key.verify_key.encode(encoder=HexEncoder).decode()
+    funding = {'type': 'transaction', 'height': 0, 'outputs': [{'pubkey': pubkey, 'value': 10} for _ in range(inputs)]}
+    funding_id = Envelope(funding).id
+    db.objects[funding_id] = funding
+    utxos.apply(funding_id, funding)
+
+    tx = {
+        'type': 'transaction',
+        'inputs': [{'outpoint': {'txid': funding_id, 'index': i}, 'sig': None} for i in range(inputs)],
+        'outputs': [{'pubkey': pubkey, 'value': 10 * inputs}]
+    }
+    sig = key.sign(canonicalize(tx)).signature.hex()
+    for inp in tx['inputs']:
+        inp['sig'] = sig
+    return tx
+
+
+def old_check_inputs(obj, db):
+    tx = copy.deepcopy(obj)
+    for inp in tx['inputs']:
+        inp['sig'] = None
+    for inp in obj['inputs']:
+        funding = db.get(inp['outpoint']['txid'])
+        pubkey = VerifyKey(funding['outputs'][inp['outpoint']['index']]['pubkey'], encoder=HexEncoder)
+        pubkey.verify(bytes(inp['sig'], 'utf-8') + bytes(canonicalize(tx).hex(), 'utf-8'), encoder=HexEncoder)
+
+
+def bench(workers=4):
+    db, key = MemoryDB(), SigningKey(SEED)
+    utxos = make_utxos(db)
+    verifiers = [
+        ('inline', None),
+        ('thread', SignatureVerifier(workers, 'thread')),
+        ('process', SignatureVerifier(workers, 'process')),
+    ]
+    for inputs in (1, 10, 50, 200):
+        tx = make_transaction(db, utxos, key, inputs)
+        envelope = Envelope(tx)
+        number = max(1, 200 // inputs)
+        old = min(timeit.repeat(lambda: old_check_inputs(tx, db), number=number, repeat=3)) / number
+        line = '%3d inputs: old %8.2f ms' % (inputs, old * 1e3)
+        for (name, verifier) in verifiers:
+            Transaction(envelope, utxos, verifier=verifier)
+            new = min(timeit.repeat(lambda: Transaction(envelope, utxos, verifier=verifier), number=number, repeat=3)) / number
+            line += '  %s %7.2f ms (%.1fx)' % (name, new * 1e3, old / new)
+        print(line)
+    for (_, verifier) in verifiers:
+        if verifier is not None:
+            verifier.shutdown()
+
+
+if __name__ == '__main__':
+    bench()
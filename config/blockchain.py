@@ -3,3 +3,5 @@ GENESIS_ID = '00000000a420b7cefa2b7730243316921ed59ffe836e111ca3801f82a4f5360e'
 ACCOUNT_SEED = b'abcdefghijklmnopqrstuvwxyz012345'
 
 COINBASE_VALUE = 50 * 10**9
+
+BLOCK_TARGET = '00000000abc00000000000000000000000000000000000000000000000000000'
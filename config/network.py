@@ -3,3 +3,36 @@ SERVER_PORT = 18018
 
 PEER_HOST = 'keftes.di.uoa.gr'
 PEER_PORT = 18018
+
+# Longest newline-terminated message accepted from or sent to a peer
+MAX_FRAME_LENGTH = 1 << 20
+
+# Stop draining a peer's outbox while its transport buffers more than WRITE_HIGH_WATER
+# bytes, and drop the peer once the outbox itself grows past OUTBOX_LIMIT bytes
+WRITE_HIGH_WATER = 256 << 10
+OUTBOX_LIMIT = 8 << 20
+
+# Object ids remembered per peer as already known to it, so they are not announced again
+KNOWN_INVENTORY_ENTRIES = 10000
+
+# Peer host names: cache addresses for DNS_TTL seconds and failed lookups for
+# DNS_NEGATIVE_TTL, give up on a lookup after DNS_TIMEOUT and on a dial after CONNECT_TIMEOUT
+DNS_TTL = 300
+DNS_NEGATIVE_TTL = 60
+DNS_TIMEOUT = 5
+DNS_CACHE_ENTRIES = 1024
+CONNECT_TIMEOUT = 5
+
+# Peer connections: at most MAX_OUTBOUND dialed and MAX_INBOUND accepted
+MAX_OUTBOUND = 8
+MAX_INBOUND = 32
+
+# Address book size, addresses passed on in a peers message and the base of the
+# redial backoff in seconds, doubled after every failure
+ADDRBOOK_MAX_ENTRIES = 1000
+PEERS_SHARED = 30
+PEER_RETRY_BASE = 30
+
+# Seconds between peer maintenance rounds, and the score below which a peer is dropped
+PEER_MAINTENANCE_INTERVAL = 30
+PEER_MIN_SCORE = -50
@@ -4,4 +4,67 @@ VERSION_REGEX = '%d\.%d\.\d+' % (MAJOR, MINOR)
 
 AGENT = 'Penguin-Core %d.%d.0' % (MAJOR, MINOR)
 
-DB_PATH = 'database.json'
+# Storage backend: 'log' (append-only log), 'sqlite' or 'json' (legacy single file)
+DB_BACKEND = 'log'
+DB_PATH = 'database.log'
+
+# Compact the log once dead records take up this share of the file
+DB_COMPACT_RATIO = 0.5
+DB_COMPACT_MIN_BYTES = 1 << 20
+# Fold recent writes into the on-disk log index once this many keys changed
+DB_INDEX_CHECKPOINT_ENTRIES = 4096
+
+# Buffer writes and hand them to the backend together, at most
+# DB_GROUP_COMMIT_COUNT writes or DB_GROUP_COMMIT_WINDOW seconds at a time
+DB_GROUP_COMMIT = False
+DB_GROUP_COMMIT_WINDOW = 0.05
+DB_GROUP_COMMIT_COUNT = 256
+
+# When to fsync committed writes: 'always', 'periodic' (every DB_FSYNC_INTERVAL seconds) or 'os'
+DB_FSYNC = 'os'
+DB_FSYNC_INTERVAL = 1.0
+
+# Decoded objects kept in memory in front of the backend
+DB_CACHE_ENTRIES = 10000
+DB_CACHE_BYTES = 64 << 20
+
+# Ids of objects that already passed validation
+VALIDATED_CACHE_ENTRIES = 100000
+
+# Signature verification pool: 'thread' or 'process' workers, 0 to verify inline
+VERIFY_MODE = 'thread'
+VERIFY_WORKERS = 4
+VERIFY_BATCH_SIZE = 8
+
+# Save the UTXO set snapshot after this many accepted transactions
+UTXO_SNAPSHOT_INTERVAL = 10000
+
+# Deepest chain reorganisation followed: undo data is kept for this many main
+# chain blocks and the transactions of this many side branch blocks
+REORG_MAX_DEPTH = 100
+
+# Coinbase transactions received before their block, kept until it arrives
+PENDING_COINBASE_ENTRIES = 1000
+
+# Seconds a block may spend fetching its missing transactions,
+# waiting for its parent to be accepted and verifying signatures
+BLOCK_FETCH_TIMEOUT = 30
+BLOCK_PARENT_TIMEOUT = 120
+BLOCK_VERIFY_TIMEOUT = 30
+
+# Objects waiting for a missing parent: at most ORPHAN_MAX_ENTRIES of them taking
+# ORPHAN_MAX_BYTES, each dropped after ORPHAN_EXPIRY seconds
+ORPHAN_MAX_ENTRIES = 1000
+ORPHAN_MAX_BYTES = 16 << 20
+ORPHAN_EXPIRY = 600
+
+# Ask another announcing peer for an object after REQUEST_TIMEOUT seconds, and
+# keep at most REQUEST_MAX_PER_PEER object requests in flight to one peer
+REQUEST_TIMEOUT = 5
+REQUEST_MAX_PER_PEER = 64
+
+# Initial sync: transaction requests in flight, transactions kept until their
+# block is validated, and seconds without a new block before giving up
+IBD_WINDOW = 256
+IBD_MAX_PREFETCH = 20000
+IBD_STALL_TIMEOUT = 60
@@ -0,0 +1,140 @@
+##########################################################################
+# Fast JCS canonicalization for the objects Marabu actually exchanges    #
+##########################################################################
+
+import json
+from json.encoder import encode_basestring
+
+from .Canonicalize import canonicalize as slow_canonicalize
+
+# Integers up to 2^53 survive the float round trip of convert2Es6Format
+# unchanged, so their JCS form is their plain decimal form
+MAX_SAFE_INTEGER = 2 ** 53
+
+_encode = json.JSONEncoder(
+    ensure_ascii=False,
+    check_circular=False,
+    allow_nan=False,
+    sort_keys=True,
+    separators=(',', ':')
+).encode
+
+
+def _is_simple(o):
+    """True if the C json encoder produces the JCS form of `o` byte for byte.
+
+    That holds for strings, safe integers, booleans, null, lists and dicts
+    with ASCII keys (whose code point order equals the UTF-16 order JCS
+    sorts by). Floats, big integers and other keys take the general path.
+    """
+    t = type(o)
+    if t is str or o is None or t is bool:
+        return True
+    if t is int:
+        return -MAX_SAFE_INTEGER <= o <= MAX_SAFE_INTEGER
+    if t is dict:
+        for (k, v) in o.items():
+            if type(k) is not str or not k.isascii() or not _is_simple(v):
+                return False
+        return True
+    if t is list:
+        for v in o:
+            if not _is_simple(v):
+                return False
+        return True
+    return False
+
+
+def _key_order(a, b):
+    if a.isascii() and b.isascii():
+        return a < b
+    return a.encode('utf-16_be') < b.encode('utf-16_be')
+
+
+def canonical_length(o):
+    """Length in bytes of the JCS form of `o`, or None if the fast path cannot tell.
+
+    Dict keys have to be in canonical order already, since the length of a
+    JSON text does not depend on key order.
+    """
+    t = type(o)
+    if t is str:
+        if o.isascii() and o.isprintable():
+            return len(o) + 2 + o.count('"') + o.count('\\')
+        return len(encode_basestring(o).encode('utf-8'))
+    if t is int:
+        if -MAX_SAFE_INTEGER <= o <= MAX_SAFE_INTEGER:
+            return len(str(o))
+        return None
+    if t is dict:
+        length, previous = 1 + 2 * len(o) if o else 2, None
+        for (k, v) in o.items():
+            if type(k) is not str or (previous is not None and not _key_order(previous, k)):
+                return None
+            value_length = canonical_length(v)
+            if value_length is None:
+                return None
+            length += canonical_length(k) + value_length
+            previous = k
+        return length
+    if t is list:
+        length = 1 + len(o) if o else 2
+        for v in o:
+            value_length = canonical_length(v)
+            if value_length is None:
+                return None
+            length += value_length
+        return length
+    if o is True or o is None:
+        return 4
+    if o is False:
+        return 5
+    return None
+
+
+def plain_canonical_length(o):
+    """canonical_length for values whose strings are all ASCII and need no escaping.
+
+    This holds for anything parsed from ASCII JSON without backslashes, which
+    is what honest Marabu peers send.
+    """
+    t = type(o)
+    if t is str:
+        return len(o) + 2
+    if t is dict:
+        length, previous = 1 + 2 * len(o) if o else 2, ''
+        for (k, v) in o.items():
+            if not previous < k:
+                return None
+            value_length = plain_canonical_length(v)
+            if value_length is None:
+                return None
+            length += len(k) + 2 + value_length
+            previous = k
+        return length
+    if t is list:
+        length = 1 + len(o) if o else 2
+        for v in o:
+            value_length = plain_canonical_length(v)
+            if value_length is None:
+                return None
+            length += value_length
+        return length
+    if t is int:
+        if -MAX_SAFE_INTEGER <= o <= MAX_SAFE_INTEGER:
+            return len(str(o))
+        return None
+    if o is True or o is None:
+        return 4
+    if o is False:
+        return 5
+    return None
+
+
+def canonicalize(obj, utf8=True):
+    if _is_simple(obj):
+        textVal = _encode(obj)
+        if utf8:
+            return textVal.encode()
+        return textVal
+    return slow_canonicalize(obj, utf8)
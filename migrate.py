@@ -0,0 +1,13 @@
+import sys
+import config
+from src.database import PenguinDB
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+if len(sys.argv) != 2:
+    sys.exit('Usage: python migrate.py <database.json>')
+
+db = PenguinDB(config.node.DB_PATH)
+db.import_json(sys.argv[1])
+db.close()
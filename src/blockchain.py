@@ -1,108 +1,245 @@
-from library.Canonicalize import canonicalize
+from library.FastCanonicalize import canonicalize
 from hashlib import sha256
-from nacl.signing import SigningKey, VerifyKey
-from nacl.encoding import HexEncoder
-from nacl import exceptions as nacl_exceptions
 import logging
+import re
+import time
 import config
-import copy
-from .exceptions import BlockhainError
+from .exceptions import BlockhainError, DoubleSpendError, MissingTransactionError
+from .verify import DeferredVerifier, verify_chunk
+
+
+PUBKEY = re.compile('[0-9a-f]{64}')
+OBJECT_ID = PUBKEY
+
+
+class Envelope:
+    """An object as received, with its canonical encoding and id computed once.
+
+    The canonical bytes are what gets hashed, stored and served back to peers.
+    """
+
+    def __init__(self, obj, raw=None):
+        self.obj = obj
+        self.raw = canonicalize(obj) if raw is None else raw
+        self.id = sha256(self.raw).hexdigest()
 
 
 class UTxO:
     log = logging.getLogger('UTxO')
 
-    def __init__(self, outpoint, db):
-        self.db = db
-
+    def __init__(self, outpoint, utxos):
         self.tx_id = outpoint['txid']
         self.index = outpoint['index']
 
-        tx = self.db.get(self.tx_id)
-        if not tx:
-            raise BlockhainError('Transaction %s not in db' % self.tx_id)
+        output = utxos.get(self.tx_id, self.index)
+        if output is None:
+            if utxos.is_spent(self.tx_id, self.index):
+                raise DoubleSpendError('Output %d of %s is already spent' % (self.index, self.tx_id))
+            if utxos.known(self.tx_id):
+                raise BlockhainError('Transaction %s has no output %s' % (self.tx_id, self.index))
+            raise MissingTransactionError('Transaction %s not in db' % self.tx_id)
 
-        self.pubkey = VerifyKey(tx['outputs'][self.index]['pubkey'], encoder=HexEncoder)
-        self.value = tx['outputs'][self.index]['value']
+        (self.pubkey, self.value) = output
 
 
 class Transaction:
     log = logging.getLogger('Transaction')
 
-    def __init__(self, obj, db, coinbase=False):
-        self.id = sha256(canonicalize(obj)).hexdigest()
-        self.db = db
+    def __init__(self, envelope, utxos, coinbase=False, verifier=None):
+        self.id = envelope.id
+        self.utxos = utxos
+        self.verifier = verifier
+        self.signing_bytes = None
+        obj = envelope.obj
         if coinbase:
             if not all([
                 'inputs' not in obj,
                 len(obj['outputs']) == 1,
-                obj['outputs'][0]['value'] == config.blockchain.COINBASE_VALUE
+                isinstance(obj['outputs'][0]['value'], int) and not isinstance(obj['outputs'][0]['value'], bool),
+                obj['outputs'][0]['value'] == config.blockchain.COINBASE_VALUE,
+                PUBKEY.fullmatch(obj['outputs'][0]['pubkey'])
             ]):
                 raise BlockhainError('Coinbase tx %s is malformed' % self.id)
             self.valid = True
             return
 
         self.conservation = 0
-        self.check_inputs(obj)
+        if not self.check_inputs(obj):
+            self.valid = False
+            return
         self.outputs = obj['outputs']
         for output in self.outputs:
+            if not all([
+                isinstance(output['value'], int) and not isinstance(output['value'], bool),
+                0 <= output['value'] < 2**64,
+                PUBKEY.fullmatch(output['pubkey'])
+            ]):
+                raise BlockhainError('Tx %s has a malformed output' % self.id)
             self.conservation += output['value']
         if not self.conservation <= 0:
             raise BlockhainError('Tx %s does not respect law of conservation' % self.id)
 
         self.valid = True
 
+    def signing_message(self, obj):
+        """Canonical bytes of the transaction with every signature nulled, built once.
+
+        Only the inputs are copied; the rest of the object is shared with `obj`.
+        """
+        if self.signing_bytes is None:
+            unsigned = dict(obj)
+            unsigned['inputs'] = [dict(inp, sig=None) for inp in obj['inputs']]
+            self.signing_bytes = canonicalize(unsigned)
+        return self.signing_bytes
+
     def check_inputs(self, obj):
-        tx = copy.deepcopy(obj)
-        for inp in tx['inputs']:
-            inp['sig'] = None
+        message = self.signing_message(obj)
 
         self.inputs = obj['inputs']
+        jobs, utxos, outpoints = [], [], set()
+        self.missing = set()
         for inp in self.inputs:
-            sig_bytes = bytes(inp['sig'], 'utf-8')
+            (tx_id, index) = (inp['outpoint']['txid'], inp['outpoint']['index'])
+            if not all([
+                isinstance(tx_id, str) and OBJECT_ID.fullmatch(tx_id),
+                isinstance(index, int) and not isinstance(index, bool),
+            ]) or index < 0:
+                raise BlockhainError('Tx %s has a malformed input' % self.id)
+            outpoint = (tx_id, index)
+            if outpoint in outpoints:
+                raise BlockhainError('Tx %s spends output %d of %s twice' % (self.id, outpoint[1], outpoint[0]))
+            outpoints.add(outpoint)
             try:
-                utxo = UTxO(inp['outpoint'], self.db)
-            except BlockhainError:
+                utxo = UTxO(inp['outpoint'], self.utxos)
+            except MissingTransactionError:
                 self.log.debug('UTxO not found for tx %s' % inp['outpoint']['txid'])
-                self.valid = False
-                return
+                self.missing.add(inp['outpoint']['txid'])
+                continue
             try:
-                utxo.pubkey.verify(sig_bytes + bytes(canonicalize(tx).hex(), 'utf-8'), encoder=HexEncoder)
-            except nacl_exceptions.BadSignatureError:
-                raise BlockhainError('Invalid signature for tx %s, UTxO index %d' % (self.id, utxo.index))
+                sig = bytes.fromhex(inp['sig'])
+            except (TypeError, ValueError):
+                # Fails verification in order with the other inputs
+                sig = b''
+            jobs.append((utxo.pubkey, message, sig))
+            utxos.append(utxo)
+        if self.missing:
+            return False
+
+        bad = self.verifier.verify(jobs) if self.verifier else verify_chunk(jobs)
+        if bad is not None:
+            raise BlockhainError('Invalid signature for tx %s, UTxO index %d' % (self.id, utxos[bad].index))
+        for utxo in utxos:
             self.conservation -= utxo.value
+        return True
 
 
 class Block:
-    log = logging.getLogger('Block')
-
-    def __init__(self, obj, db):
-        self.id = sha256(canonicalize(obj)).hexdigest()
-        self.db = db
-
-        self.valid = False
+    """A block whose header passed the target, proof of work and timestamp checks.
 
+    Its transactions are validated by the BlockPipeline.
+    """
+    log = logging.getLogger('Block')
 
-def parse_object(obj_dict, node, peer_id, coinbase=False):
+    def __init__(self, envelope):
+        self.id = envelope.id
+        self.envelope = envelope
+        obj = envelope.obj
+        if not all([
+            obj['T'] == config.blockchain.BLOCK_TARGET,
+            isinstance(obj['created'], int),
+            isinstance(obj['txids'], list),
+            all(isinstance(tx_id, str) for tx_id in obj['txids'])
+        ]):
+            raise BlockhainError('Block %s is malformed' % self.id)
+        if not int(self.id, 16) < int(obj['T'], 16):
+            raise BlockhainError('Block %s does not meet the target' % self.id)
+        if obj['created'] > time.time():
+            raise BlockhainError('Block %s is created in the future' % self.id)
+        if len(set(obj['txids'])) != len(obj['txids']):
+            raise BlockhainError('Block %s lists a transaction twice' % self.id)
+
+        self.previd = obj['previd']
+        self.created = obj['created']
+        self.txids = obj['txids']
+        if self.previd is None and self.id != config.blockchain.GENESIS_ID:
+            raise BlockhainError('Block %s has no parent' % self.id)
+
+    def check_parent(self, chain):
+        """Return whether the parent is indexed, checking the timestamp against it."""
+        if self.previd is None:
+            return True
+        parent = chain.get(self.previd)
+        if parent is None:
+            self.log.debug('Parent %s of block %s not indexed' % (self.previd, self.id))
+            return False
+        if not self.created > parent.created:
+            raise BlockhainError('Block %s is not created after its parent' % self.id)
+        return True
+
+
+def parse_object(envelope, node, peer_id, coinbase=False):
     log = logging.getLogger('Parser')
     db = node.db
 
-    obj_id = sha256(canonicalize(obj_dict)).hexdigest()
+    obj_dict, obj_id = envelope.obj, envelope.id
+    if obj_id in node.validated or obj_id in node.mempool or obj_id in node.utxos.applied or obj_id in node.chain or (
+        obj_id in node.verifying
+    ):
+        log.debug('Object %s already validated' % obj_id)
+        return
+
     if obj_dict['type'] == 'transaction':
-        log.info('%s sent tx %s with id %s' % (peer_id, obj_dict, obj_id))
+        log.info('%s sent tx with id %s' % (peer_id, obj_id))
+        if not coinbase and 'inputs' not in obj_dict:
+            # Miners send a coinbase before the block it is valid in
+            try:
+                Transaction(envelope, node.mempool, True)
+            except (KeyError, TypeError):
+                raise BlockhainError('Transaction %s is malformed' % obj_id)
+            log.info('Keeping coinbase %s until its block arrives' % obj_id)
+            node.pipeline.coinbases.put(obj_id, envelope)
+            return
+        # Signatures are only recorded here and verified off the event loop
+        verifier = DeferredVerifier()
         try:
-            obj = Transaction(obj_dict, db, coinbase)
-        except KeyError:
+            obj = Transaction(envelope, node.mempool, coinbase, verifier)
+        except (KeyError, TypeError):
             raise BlockhainError('Transaction %s is malformed' % obj_id)
     elif obj_dict['type'] == 'block':
-        log.info('%s sent block %s with id %s' % (peer_id, obj_dict, obj_id))
-        obj = Block(obj_dict, db)
-        if obj_id == config.blockchain.GENESIS_ID:
-            obj.valid = True
+        log.info('%s sent block with id %s' % (peer_id, obj_id))
+        if obj_id in node.pipeline:
+            return
+        try:
+            block = Block(envelope)
+        except (KeyError, TypeError, ValueError):
+            raise BlockhainError('Block %s is malformed' % obj_id)
+        if block.check_parent(node.chain) or block.previd in node.pipeline:
+            node.pipeline.submit(block, peer_id)
+        elif not node.sync.hold(block, peer_id):
+            node.hold_orphan(envelope, peer_id, [block.previd])
+        return
     else:
         raise BlockhainError('Unknown object type with id %s' % obj_id)
 
-    if obj.valid and not db.get(obj_id):
-        log.info('Adding object %s to db' % obj_id)
-        db.set(obj_id, obj_dict)
-        node.broadcast_object(obj_id)
+    if not obj.valid:
+        node.hold_orphan(envelope, peer_id, obj.missing)
+        return
+    if verifier.jobs:
+        node.verify_transaction(envelope, peer_id, coinbase, verifier.jobs)
+        return
+    accept_transaction(envelope, node, coinbase)
+
+
+def accept_transaction(envelope, node, coinbase=False):
+    """Store a transaction whose signatures are verified, and pass it on."""
+    log = logging.getLogger('Parser')
+    db = node.db
+
+    node.validated.put(envelope.id, True)
+    if not coinbase:
+        node.mempool.add(envelope)
+    if not db.get(envelope.id):
+        log.info('Adding object %s to db' % envelope.id)
+        db.set_raw(envelope.id, envelope.raw, envelope.obj)
+        node.broadcast_object(envelope.id)
+    node.adopt_orphans(envelope.id)
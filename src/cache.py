@@ -0,0 +1,68 @@
+import collections
+import threading
+
+
+class LRUCache:
+    """Least recently used cache bounded by entry count and approximate size.
+
+    `size` is supplied by the caller on `put`, usually the length of the
+    encoded value. Hits, misses and evictions are counted for `stats`.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.hits, self.misses, self.evictions = 0, 0, 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key][0]
+
+    def put(self, key, value, size=0):
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+            self.entries[key] = (value, size)
+            self.bytes += size
+            while self.entries and (
+                len(self.entries) > self.max_entries
+                or (self.max_bytes is not None and self.bytes > self.max_bytes)
+            ):
+                (_, (_, evicted_size)) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def pop(self, key):
+        with self.lock:
+            if key in self.entries:
+                self.bytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
@@ -0,0 +1,176 @@
+import collections
+import logging
+import os
+import struct
+
+
+IndexEntry = collections.namedtuple('IndexEntry', ['parent', 'height', 'created', 'work'])
+
+
+def block_work(target):
+    """Expected number of hashes to find a block id below `target`."""
+    return 2**256 // (int(target, 16) + 1)
+
+
+class BlockIndex:
+    """Chain structure of every accepted block, kept in memory.
+
+    Each block id maps to its parent, height, timestamp and cumulative work.
+    The best tip, the one with the most work (the first seen wins ties), is
+    updated as blocks are added, together with the list of main chain ids by
+    height, so tip, height and most ancestor queries are O(1).
+
+    Entries are appended to a file of fixed size records at `location`, so
+    opening the index reads that file only, and the tip is stored in the
+    database under `chaintip`. A record is written once the block's database
+    writes are committed and synced together with the database, and records
+    at the end of the file whose block is not stored are dropped on open.
+    Databases that still keep the entries under `index:<block id>` keys are
+    migrated to the file the first time.
+    """
+    log = logging.getLogger('BlockIndex')
+
+    PREFIX = 'index:'
+    # Block id, parent id (zeros for genesis), height, created, cumulative work
+    RECORD = struct.Struct('>32s32sQq40s')
+
+    def __init__(self, db, location):
+        self.db = db
+        self.location = location
+        self.entries = {}
+        self.tip = None
+        self.main_chain = []
+
+        self.load()
+        self.file = open(self.location, 'ab')
+        self.db.sync_hooks.append(self.sync)
+
+    def __contains__(self, block_id):
+        return block_id in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, block_id):
+        return self.entries.get(block_id)
+
+    def height(self, block_id=None):
+        entry = self.entries.get(self.tip if block_id is None else block_id)
+        return None if entry is None else entry.height
+
+    def on_main_chain(self, block_id):
+        entry = self.entries.get(block_id)
+        return entry is not None and entry.height < len(self.main_chain) and self.main_chain[entry.height] == block_id
+
+    def ancestor(self, block_id, height):
+        """Return the id of the ancestor of `block_id` at `height`, or None."""
+        entry = self.entries.get(block_id)
+        if entry is None or not 0 <= height <= entry.height:
+            return None
+        while not self.on_main_chain(block_id):
+            if entry.height == height:
+                return block_id
+            block_id = entry.parent
+            entry = self.entries[block_id]
+        return self.main_chain[height]
+
+    def add(self, block_id, block):
+        """Index an accepted block whose parent is already indexed.
+
+        Returns True if the block became the new tip.
+        """
+        if block_id in self.entries:
+            return False
+        parent_id = block['previd']
+        if parent_id is None:
+            entry = IndexEntry(None, 0, block['created'], block_work(block['T']))
+        else:
+            parent = self.entries[parent_id]
+            entry = IndexEntry(parent_id, parent.height + 1, block['created'], parent.work + block_work(block['T']))
+
+        self.entries[block_id] = entry
+        self.db.after_commit(lambda: self.append([(block_id, entry)]))
+        if self.tip is not None and entry.work <= self.entries[self.tip].work:
+            return False
+        self.set_tip(block_id)
+        self.db.set('chaintip', block_id)
+        return True
+
+    def set_tip(self, block_id):
+        """Make `block_id` the tip, replacing the main chain above the fork point."""
+        if self.tip is not None and self.entries[block_id].parent != self.tip:
+            self.log.info('Chain reorganisation to %s' % block_id)
+        self.tip = block_id
+        branch = []
+        while block_id is not None and not self.on_main_chain(block_id):
+            branch.append(block_id)
+            block_id = self.entries[block_id].parent
+        del self.main_chain[0 if block_id is None else self.entries[block_id].height + 1:]
+        self.main_chain.extend(reversed(branch))
+        self.log.info('New chaintip %s at height %d' % (self.tip, self.entries[self.tip].height))
+
+    def append(self, items):
+        self.file.write(b''.join(
+            self.RECORD.pack(
+                bytes.fromhex(block_id),
+                bytes(32) if entry.parent is None else bytes.fromhex(entry.parent),
+                entry.height, entry.created, entry.work.to_bytes(40, 'big')
+            )
+            for (block_id, entry) in items
+        ))
+        self.file.flush()
+
+    def sync(self):
+        if not self.file.closed:
+            os.fsync(self.file.fileno())
+
+    def load(self):
+        try:
+            with open(self.location, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            data = None
+
+        if data is not None:
+            end = len(data) - len(data) % self.RECORD.size
+            # Blocks written after the database's last durable commit
+            while end and not self.db.get_raw(data[end - self.RECORD.size:end - self.RECORD.size + 32].hex()):
+                end -= self.RECORD.size
+            if end != len(data):
+                self.log.error('Dropping %d bytes of records without a stored block from %s' % (len(data) - end, self.location))
+                with open(self.location, 'r+b') as f:
+                    f.truncate(end)
+            for (block_id, parent, height, created, work) in self.RECORD.iter_unpack(data[:end]):
+                self.entries[block_id.hex()] = IndexEntry(
+                    None if parent == bytes(32) else parent.hex(), height, created, int.from_bytes(work, 'big')
+                )
+        elif self.db.get('chaintip'):
+            self.migrate()
+
+        if self.entries:
+            # The stored tip is only a tie-breaker, the most work decides
+            tip = self.db.get('chaintip')
+            best = max(self.entries, key=lambda block_id: self.entries[block_id].work)
+            if tip not in self.entries or self.entries[tip].work < self.entries[best].work:
+                tip = best
+            self.set_tip(tip)
+            self.log.info('Loaded %d blocks, chaintip %s' % (len(self.entries), self.tip))
+
+    def migrate(self):
+        """Move entries kept under `index:<block id>` keys to the index file."""
+        for key in self.db.keys():
+            if key.startswith(self.PREFIX):
+                self.entries[key[len(self.PREFIX):]] = IndexEntry(*self.db.get(key))
+        # Parents first, so a torn write never leaves a child without its parent
+        items = sorted(self.entries.items(), key=lambda item: item[1].height)
+        self.file = open(self.location, 'ab')
+        self.append(items)
+        self.sync()
+        self.file.close()
+        with self.db.batch():
+            for (block_id, _) in items:
+                self.db.delete(self.PREFIX + block_id)
+        self.log.info('Moved %d index entries to %s' % (len(items), self.location))
+
+    def close(self):
+        self.file.close()
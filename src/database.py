@@ -1,35 +1,730 @@
+import abc
+import contextlib
+import hashlib
 import json
 import logging
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+import config
+from .cache import LRUCache
 
-class PenguinDB:
-    log = logging.getLogger('DB')
+
+class Backend(abc.ABC):
+    """Raw key/value storage behind PenguinDB.
+
+    Keys are strings and values are the JSON encoded bytes of the stored
+    object; `get` returns None for missing keys.
+    """
+
+    @abc.abstractmethod
+    def get(self, key):
+        pass
+
+    @abc.abstractmethod
+    def put(self, key, value):
+        pass
+
+    @abc.abstractmethod
+    def delete(self, key):
+        pass
+
+    @abc.abstractmethod
+    def keys(self):
+        pass
+
+    def write_batch(self, items):
+        """Apply (key, value) pairs in order; a value of None deletes the key."""
+        for (key, value) in items:
+            if value is None:
+                self.delete(key)
+            else:
+                self.put(key, value)
+
+    def sync(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class JSONBackend(Backend):
+    """The original format: one JSON dict rewritten in full on every write."""
 
     def __init__(self, location):
         self.location = location
         try:
             self.db = json.loads(open(location).read())
         except FileNotFoundError:
-            self.db = {'peers': []}
+            self.db = {}
             self.dumpdb()
 
     def dumpdb(self):
         open(self.location, 'w').write(json.dumps(self.db))
 
-    def set(self, key, value):
-        self.db[str(key)] = value
-        self.dumpdb()
-        return True
-
     def get(self, key):
-        try:
-            return self.db[str(key)]
-        except KeyError:
-            self.log.debug('No key %s found in db' % str(key))
-            return False
+        if key not in self.db:
+            return None
+        return json.dumps(self.db[key]).encode('utf-8')
+
+    def put(self, key, value):
+        self.db[key] = json.loads(value)
+        self.dumpdb()
 
     def delete(self, key):
-        if key not in self.db.keys():
+        if key not in self.db:
             return False
         del self.db[key]
         self.dumpdb()
         return True
+
+    def keys(self):
+        return list(self.db.keys())
+
+    def write_batch(self, items):
+        for (key, value) in items:
+            if value is None:
+                self.db.pop(key, None)
+            else:
+                self.db[key] = json.loads(value)
+        self.dumpdb()
+
+
+class LogBackend(Backend):
+    """Append-only key/value log with a persistent, memory-mapped index.
+
+    Every record is `header | key | value`, where the header holds a crc32 of
+    the payload, the key length and the value length. A value length of
+    TOMBSTONE marks a deletion.
+
+    The index lives next to the log in `<location>.idx`: a header followed by
+    fixed-size entries (key digest, record offset, key length, value length)
+    sorted by digest. It is mmapped and binary searched, so opening the store
+    only scans the log written after the last index checkpoint. Those recent
+    writes are kept in the `overlay` dict until a background checkpoint folds
+    them into a new index file. Dead records are reclaimed by compaction,
+    which also runs on a background thread once they take up enough of the
+    file.
+    """
+    log = logging.getLogger('LogBackend')
+
+    HEADER = struct.Struct('>III')
+    TOMBSTONE = 0xffffffff
+
+    INDEX_MAGIC = b'PIX1'
+    INDEX_HEADER = struct.Struct('>4sQQQ')
+    INDEX_ENTRY = struct.Struct('>16sQHI')
+
+    def __init__(self, location, compact_ratio=0.5, compact_min_bytes=1 << 20, checkpoint_entries=4096):
+        self.location = location
+        self.index_location = location + '.idx'
+        self.compact_ratio = compact_ratio
+        self.compact_min_bytes = compact_min_bytes
+        self.checkpoint_entries = checkpoint_entries
+
+        self.lock = threading.Lock()
+        self.maintenance = None
+        self.overlay = {}
+        self.mapped, self.count = None, 0
+        self.dead_bytes = 0
+
+        self.file = open(location, 'a+b')
+        self.end = self.load()
+
+    @staticmethod
+    def digest(key_bytes):
+        return hashlib.blake2b(key_bytes, digest_size=16).digest()
+
+    def load(self):
+        covered = self.open_index()
+        size = os.fstat(self.file.fileno()).st_size
+        if covered > size:
+            self.log.warning('Index of %s is ahead of the log, rebuilding it' % self.location)
+            self.map_index(None)
+            covered, self.dead_bytes = 0, 0
+
+        offset = covered
+        for (key, record_offset, value_length, record_end) in self.scan(self.file, covered):
+            self.discard(key)
+            if value_length == self.TOMBSTONE:
+                self.overlay[key] = None
+                self.dead_bytes += record_end - record_offset
+            else:
+                self.overlay[key] = (record_offset, value_length)
+            offset = record_end
+
+        if offset != size:
+            self.log.warning('Truncating %d bytes of torn writes from %s' % (size - offset, self.location))
+            self.file.truncate(offset)
+        return offset
+
+    def open_index(self):
+        try:
+            f = open(self.index_location, 'rb')
+        except FileNotFoundError:
+            return 0
+        with f:
+            header = f.read(self.INDEX_HEADER.size)
+            if len(header) < self.INDEX_HEADER.size:
+                return 0
+            (magic, covered, dead_bytes, count) = self.INDEX_HEADER.unpack(header)
+            expected_size = self.INDEX_HEADER.size + count * self.INDEX_ENTRY.size
+            if magic != self.INDEX_MAGIC or os.fstat(f.fileno()).st_size != expected_size:
+                self.log.warning('Ignoring malformed index %s' % self.index_location)
+                return 0
+            self.map_index(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if count else None, count)
+        self.dead_bytes = dead_bytes
+        return covered
+
+    def map_index(self, mapped, count=0):
+        if self.mapped is not None:
+            self.mapped.close()
+        self.mapped, self.count = mapped, count
+
+    def entry(self, i):
+        return self.INDEX_ENTRY.unpack_from(self.mapped, self.INDEX_HEADER.size + i * self.INDEX_ENTRY.size)
+
+    def search(self, key):
+        if not self.count:
+            return None
+        digest = self.digest(key.encode('utf-8'))
+        (lo, hi) = (0, self.count)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = self.INDEX_HEADER.size + mid * self.INDEX_ENTRY.size
+            if self.mapped[start:start + 16] < digest:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == self.count:
+            return None
+        (entry_digest, record_offset, _, value_length) = self.entry(lo)
+        if entry_digest != digest:
+            return None
+        return (record_offset, value_length)
+
+    def lookup(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        return self.search(key)
+
+    def scan(self, f, offset):
+        f.seek(offset)
+        while True:
+            header = f.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                return
+            (crc, key_length, value_length) = self.HEADER.unpack(header)
+            payload_length = key_length + (0 if value_length == self.TOMBSTONE else value_length)
+            payload = f.read(payload_length)
+            if len(payload) < payload_length or zlib.crc32(payload) != crc:
+                return
+            key = payload[:key_length].decode('utf-8')
+            record_end = offset + self.HEADER.size + payload_length
+            yield (key, offset, value_length, record_end)
+            offset = record_end
+
+    def discard(self, key):
+        entry = self.lookup(key)
+        if entry is not None:
+            self.dead_bytes += self.HEADER.size + len(key.encode('utf-8')) + entry[1]
+
+    def record(self, key, value):
+        key_bytes = key.encode('utf-8')
+        payload = key_bytes if value is None else key_bytes + value
+        value_length = self.TOMBSTONE if value is None else len(value)
+        return self.HEADER.pack(zlib.crc32(payload), len(key_bytes), value_length) + payload
+
+    def get(self, key):
+        with self.lock:
+            entry = self.lookup(key)
+            if entry is None:
+                return None
+            (record_offset, value_length) = entry
+            key_bytes = key.encode('utf-8')
+            data = os.pread(self.file.fileno(), self.HEADER.size + len(key_bytes) + value_length, record_offset)
+        if data[self.HEADER.size:self.HEADER.size + len(key_bytes)] != key_bytes:
+            return None
+        return data[self.HEADER.size + len(key_bytes):]
+
+    def put(self, key, value):
+        self.write_batch([(key, value)])
+
+    def delete(self, key):
+        with self.lock:
+            if self.lookup(key) is None:
+                return False
+        self.write_batch([(key, None)])
+        return True
+
+    def write_batch(self, items):
+        """Append all records with a single write."""
+        with self.lock:
+            chunks, offset = [], self.end
+            for (key, value) in items:
+                data = self.record(key, value)
+                chunks.append(data)
+                self.discard(key)
+                if value is None:
+                    self.overlay[key] = None
+                    self.dead_bytes += len(data)
+                else:
+                    self.overlay[key] = (offset, len(value))
+                offset += len(data)
+            self.file.seek(0, os.SEEK_END)
+            self.file.write(b''.join(chunks))
+            self.file.flush()
+            self.end = offset
+        self.maybe_maintain()
+
+    def sync(self):
+        with self.lock:
+            os.fsync(self.file.fileno())
+
+    def keys(self):
+        with self.lock:
+            keys = [key for (key, entry) in self.overlay.items() if entry is not None]
+            for i in range(self.count):
+                (_, record_offset, key_length, _) = self.entry(i)
+                key = os.pread(self.file.fileno(), key_length, record_offset + self.HEADER.size).decode('utf-8')
+                if key not in self.overlay:
+                    keys.append(key)
+            return keys
+
+    def maybe_maintain(self):
+        if self.maintenance is not None and self.maintenance.is_alive():
+            return
+        if self.end >= self.compact_min_bytes and self.dead_bytes >= self.end * self.compact_ratio:
+            target = self.compact
+        elif len(self.overlay) >= self.checkpoint_entries:
+            target = self.checkpoint
+        else:
+            return
+        self.maintenance = threading.Thread(target=target, daemon=True)
+        self.maintenance.start()
+
+    def write_index(self, entries, covered, dead_bytes):
+        tmp_location = self.index_location + '.tmp'
+        with open(tmp_location, 'wb') as out:
+            out.write(self.INDEX_HEADER.pack(self.INDEX_MAGIC, covered, dead_bytes, len(entries)))
+            for digest in sorted(entries):
+                out.write(self.INDEX_ENTRY.pack(digest, *entries[digest]))
+            out.flush()
+            os.fsync(out.fileno())
+        return tmp_location
+
+    def swap_index(self, tmp_location, count):
+        os.replace(tmp_location, self.index_location)
+        with open(self.index_location, 'rb') as f:
+            self.map_index(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if count else None, count)
+
+    def checkpoint(self):
+        """Fold the overlay into a new index file.
+
+        The log is fsynced first so the index never covers data that could
+        still be lost. Overlay entries that changed while the index was being
+        written stay in the overlay.
+        """
+        with self.lock:
+            os.fsync(self.file.fileno())
+            snapshot, covered, dead_bytes = dict(self.overlay), self.end, self.dead_bytes
+
+        entries = {}
+        for i in range(self.count):
+            (digest, record_offset, key_length, value_length) = self.entry(i)
+            entries[digest] = (record_offset, key_length, value_length)
+        for (key, entry) in snapshot.items():
+            key_bytes = key.encode('utf-8')
+            if entry is None:
+                entries.pop(self.digest(key_bytes), None)
+            else:
+                entries[self.digest(key_bytes)] = (entry[0], len(key_bytes), entry[1])
+        tmp_location = self.write_index(entries, covered, dead_bytes)
+
+        with self.lock:
+            self.swap_index(tmp_location, len(entries))
+            for (key, entry) in snapshot.items():
+                if key in self.overlay and self.overlay[key] is entry:
+                    del self.overlay[key]
+        self.log.debug('Checkpointed index of %s with %d entries' % (self.location, len(entries)))
+
+    def compact(self):
+        """Rewrite the live records into a fresh log and index and swap them in.
+
+        The bulk copy runs without holding the lock; records appended while it
+        runs are replayed from the old log before the swap. The old index is
+        removed before the new log replaces the old one, so a crash midway
+        leaves a log without an index, which is rebuilt by a full scan.
+        """
+        tmp_location = self.location + '.compact'
+        with self.lock:
+            snapshot, snapshot_end = dict(self.overlay), self.end
+        self.log.info('Compacting %s (%d bytes, %d dead)' % (self.location, snapshot_end, self.dead_bytes))
+
+        fd = self.file.fileno()
+        live = [(key, entry[0], entry[1]) for (key, entry) in snapshot.items() if entry is not None]
+        for i in range(self.count):
+            (_, record_offset, key_length, value_length) = self.entry(i)
+            key = os.pread(fd, key_length, record_offset + self.HEADER.size).decode('utf-8')
+            if key not in snapshot:
+                live.append((key, record_offset, value_length))
+
+        entries, offset, dead_bytes = {}, 0, 0
+        with open(tmp_location, 'wb') as out:
+            def copy(key, record_offset, value_length):
+                key_bytes = key.encode('utf-8')
+                size = self.HEADER.size + len(key_bytes) + value_length
+                out.write(os.pread(fd, size, record_offset))
+                entries[self.digest(key_bytes)] = (offset, len(key_bytes), value_length)
+                return size
+
+            for (key, record_offset, value_length) in live:
+                offset += copy(key, record_offset, value_length)
+
+            with self.lock:
+                tail = {}
+                with open(self.location, 'rb') as f:
+                    for (key, record_offset, value_length, _) in self.scan(f, snapshot_end):
+                        tail[key] = (record_offset, value_length)
+                for (key, (record_offset, value_length)) in tail.items():
+                    digest = self.digest(key.encode('utf-8'))
+                    if digest in entries:
+                        dead_bytes += self.HEADER.size + entries[digest][1] + entries[digest][2]
+                    if value_length == self.TOMBSTONE:
+                        if entries.pop(digest, None) is not None:
+                            data = self.record(key, None)
+                            out.write(data)
+                            offset += len(data)
+                            dead_bytes += len(data)
+                        continue
+                    offset += copy(key, record_offset, value_length)
+                out.flush()
+                os.fsync(out.fileno())
+
+                index_tmp_location = self.write_index(entries, offset, dead_bytes)
+                self.map_index(None)
+                if os.path.exists(self.index_location):
+                    os.remove(self.index_location)
+                os.replace(tmp_location, self.location)
+                self.swap_index(index_tmp_location, len(entries))
+
+                self.file.close()
+                self.file = open(self.location, 'a+b')
+                self.overlay, self.end, self.dead_bytes = {}, offset, dead_bytes
+        self.log.info('Compacted %s to %d bytes' % (self.location, offset))
+
+    def close(self):
+        if self.maintenance is not None:
+            self.maintenance.join()
+        if self.overlay:
+            self.checkpoint()
+        with self.lock:
+            self.map_index(None)
+            self.file.close()
+
+
+class SQLiteBackend(Backend):
+    """Objects and metadata in typed sqlite3 tables.
+
+    Object ids go to `objects` and every other key lands in `metadata`. The
+    database runs in WAL mode and all statements are constant SQL, so
+    sqlite3 keeps them prepared in its statement cache. The `peers` table
+    of older databases is moved to the `peers` metadata key on open.
+    """
+    log = logging.getLogger('SQLiteBackend')
+
+    OBJECT_ID = re.compile('^[0-9a-f]{64}$')
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS objects (id TEXT PRIMARY KEY, data BLOB NOT NULL) WITHOUT ROWID',
+        'CREATE TABLE IF NOT EXISTS metadata (key TEXT PRIMARY KEY, value BLOB NOT NULL) WITHOUT ROWID',
+    )
+
+    # WAL with synchronous=FULL fsyncs every commit; with NORMAL only
+    # checkpoints fsync, which sync() forces for the 'periodic' policy
+    SYNCHRONOUS = {'always': 'FULL', 'periodic': 'NORMAL', 'os': 'NORMAL'}
+
+    def __init__(self, location, fsync='always'):
+        self.location = location
+        self.fsync = fsync
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(location, isolation_level=None, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=%s' % self.SYNCHRONOUS[fsync])
+        for statement in self.SCHEMA:
+            self.conn.execute(statement)
+        self.migrate_peers()
+
+    def migrate_peers(self):
+        if not self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'peers'").fetchone():
+            return
+        with self.conn:
+            self.conn.execute('BEGIN')
+            rows = self.conn.execute('SELECT address FROM peers ORDER BY position').fetchall()
+            if rows:
+                self.execute_put('peers', json.dumps([address for (address,) in rows]).encode('utf-8'))
+            self.conn.execute('DROP TABLE peers')
+        self.log.info('Moved %d peers to the metadata table' % len(rows))
+
+    def get(self, key):
+        with self.lock:
+            if self.OBJECT_ID.match(key):
+                row = self.conn.execute('SELECT data FROM objects WHERE id = ?', (key,)).fetchone()
+            else:
+                row = self.conn.execute('SELECT value FROM metadata WHERE key = ?', (key,)).fetchone()
+            return None if row is None else bytes(row[0])
+
+    def execute_put(self, key, value):
+        if self.OBJECT_ID.match(key):
+            self.conn.execute('INSERT OR REPLACE INTO objects (id, data) VALUES (?, ?)', (key, value))
+        else:
+            self.conn.execute('INSERT OR REPLACE INTO metadata (key, value) VALUES (?, ?)', (key, value))
+
+    def execute_delete(self, key):
+        if self.OBJECT_ID.match(key):
+            cursor = self.conn.execute('DELETE FROM objects WHERE id = ?', (key,))
+        else:
+            cursor = self.conn.execute('DELETE FROM metadata WHERE key = ?', (key,))
+        return cursor.rowcount > 0
+
+    def put(self, key, value):
+        self.write_batch([(key, value)])
+
+    def delete(self, key):
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            return self.execute_delete(key)
+
+    def write_batch(self, items):
+        """Apply all writes in one transaction."""
+        with self.lock, self.conn:
+            self.conn.execute('BEGIN')
+            for (key, value) in items:
+                if value is None:
+                    self.execute_delete(key)
+                else:
+                    self.execute_put(key, value)
+
+    def sync(self):
+        if self.fsync != 'periodic':
+            return
+        with self.lock:
+            self.conn.execute('PRAGMA wal_checkpoint(PASSIVE)')
+
+    def keys(self):
+        with self.lock:
+            keys = [key for (key,) in self.conn.execute('SELECT id FROM objects')]
+            keys += [key for (key,) in self.conn.execute('SELECT key FROM metadata')]
+            return keys
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+def open_backend(name, location, fsync='always'):
+    if name == 'log':
+        return LogBackend(
+            location,
+            compact_ratio=config.node.DB_COMPACT_RATIO,
+            compact_min_bytes=config.node.DB_COMPACT_MIN_BYTES,
+            checkpoint_entries=config.node.DB_INDEX_CHECKPOINT_ENTRIES
+        )
+    if name == 'sqlite':
+        return SQLiteBackend(location, fsync)
+    if name == 'json':
+        return JSONBackend(location)
+    raise ValueError('Unknown database backend %s' % name)
+
+
+class PenguinDB:
+    """Facade over a storage backend.
+
+    Writes made inside `batch()`, or any write while group commit is enabled,
+    are buffered and handed to the backend together. Group commits are
+    flushed once DB_GROUP_COMMIT_COUNT writes are pending or every
+    DB_GROUP_COMMIT_WINDOW seconds. DB_FSYNC picks when committed data is
+    forced to disk: after every commit ('always'), every DB_FSYNC_INTERVAL
+    seconds ('periodic') or whenever the OS decides ('os').
+
+    Decoded values are kept in an LRU cache bounded by DB_CACHE_ENTRIES and
+    DB_CACHE_BYTES of encoded size; `cache.stats()` reports its counters.
+
+    Files kept next to the database order their writes after it with
+    `after_commit`, and are forced to disk with it through `sync_hooks`.
+    """
+    log = logging.getLogger('DB')
+
+    FSYNC_POLICIES = ('always', 'periodic', 'os')
+
+    def __init__(self, location, backend=None, group_commit=None, fsync=None):
+        self.location = location
+        self.fsync = fsync or config.node.DB_FSYNC
+        if self.fsync not in self.FSYNC_POLICIES:
+            raise ValueError('Unknown fsync policy %s' % self.fsync)
+        self.group_commit = config.node.DB_GROUP_COMMIT if group_commit is None else group_commit
+        self.store = open_backend(backend or config.node.DB_BACKEND, location, self.fsync)
+
+        self.lock = threading.RLock()
+        self.pending = {}
+        self.batch_depth = 0
+        self.on_commit = []
+        self.sync_hooks = []
+        self.last_sync = time.monotonic()
+        self.cache = LRUCache(config.node.DB_CACHE_ENTRIES, config.node.DB_CACHE_BYTES)
+
+        self.closed = threading.Event()
+        if self.group_commit or self.fsync == 'periodic':
+            threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def set(self, key, value):
+        return self.set_raw(key, json.dumps(value).encode('utf-8'), value)
+
+    def set_raw(self, key, encoded, value):
+        """Store `value` using `encoded`, its already computed JSON encoding."""
+        key = str(key)
+        with self.lock:
+            self.write(key, encoded)
+            self.cache.put(key, (value, encoded), len(encoded))
+        return True
+
+    def get(self, key):
+        entry = self.lookup(str(key))
+        return False if entry is None else entry[0]
+
+    def get_raw(self, key):
+        """Return the stored JSON encoding of a key, or None if it is missing."""
+        entry = self.lookup(str(key))
+        return None if entry is None else entry[1]
+
+    def lookup(self, key):
+        entry = self.cache.get(key)
+        if entry is not None:
+            return entry
+        with self.lock:
+            encoded = self.pending[key] if key in self.pending else self.store.get(key)
+        if encoded is None:
+            self.log.debug('No key %s found in db' % key)
+            return None
+        entry = (json.loads(encoded), encoded)
+        self.cache.put(key, entry, len(encoded))
+        return entry
+
+    def keys(self):
+        with self.lock:
+            keys = set(self.store.keys())
+            for (key, value) in self.pending.items():
+                if value is None:
+                    keys.discard(key)
+                else:
+                    keys.add(key)
+            return list(keys)
+
+    def delete(self, key):
+        key = str(key)
+        with self.lock:
+            if self.get(key) is False:
+                return False
+            self.write(key, None)
+            self.cache.pop(key)
+            return True
+
+    def write(self, key, value):
+        with self.lock:
+            if not self.batch_depth and not self.group_commit:
+                self.store.write_batch([(key, value)])
+                self.synced()
+                return
+            self.pending[key] = value
+            if not self.batch_depth and len(self.pending) >= config.node.DB_GROUP_COMMIT_COUNT:
+                self.commit()
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Buffer every write in the block and commit them together on exit.
+
+        If the block raises, its writes are discarded instead.
+        """
+        with self.lock:
+            self.batch_depth += 1
+            saved, callbacks = dict(self.pending), len(self.on_commit)
+        try:
+            yield self
+        except BaseException:
+            with self.lock:
+                for key in self.pending:
+                    if key not in saved or saved[key] is not self.pending[key]:
+                        self.cache.pop(key)
+                self.pending = saved
+                del self.on_commit[callbacks:]
+                self.batch_depth -= 1
+            raise
+        with self.lock:
+            self.batch_depth -= 1
+            if not self.batch_depth and not self.group_commit:
+                self.commit()
+
+    def after_commit(self, callback):
+        """Run `callback` once the writes made so far are handed to the backend."""
+        with self.lock:
+            if self.pending or self.batch_depth:
+                self.on_commit.append(callback)
+            else:
+                callback()
+
+    def commit(self):
+        with self.lock:
+            items, self.pending = list(self.pending.items()), {}
+            if items:
+                self.store.write_batch(items)
+            callbacks, self.on_commit = self.on_commit, []
+            for callback in callbacks:
+                callback()
+            if items:
+                self.synced()
+
+    def synced(self):
+        if self.fsync == 'always':
+            self.sync()
+
+    def sync(self):
+        with self.lock:
+            self.store.sync()
+            for hook in self.sync_hooks:
+                hook()
+
+    def flush(self):
+        """Commit pending writes and force them to disk."""
+        with self.lock:
+            self.commit()
+            self.sync()
+
+    def flush_loop(self):
+        interval = config.node.DB_GROUP_COMMIT_WINDOW if self.group_commit else config.node.DB_FSYNC_INTERVAL
+        while not self.closed.wait(interval):
+            with self.lock:
+                if not self.batch_depth:
+                    self.commit()
+                if self.fsync == 'periodic' and time.monotonic() - self.last_sync >= config.node.DB_FSYNC_INTERVAL:
+                    self.sync()
+                    self.last_sync = time.monotonic()
+
+    def import_json(self, json_path):
+        """Copy every key of a legacy database.json into this database."""
+        source = json.loads(open(json_path).read())
+        with self.batch():
+            for (key, value) in source.items():
+                self.set(key, value)
+        self.log.info('Imported %d keys from %s' % (len(source), json_path))
+        return len(source)
+
+    def close(self):
+        self.closed.set()
+        with self.lock:
+            self.flush()
+            self.store.close()
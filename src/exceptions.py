@@ -1,3 +1,11 @@
 class BlockhainError(Exception):
     def __init__(self, message):
         super().__init__(message)
+
+
+class DoubleSpendError(BlockhainError):
+    pass
+
+
+class MissingTransactionError(BlockhainError):
+    pass
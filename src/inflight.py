@@ -0,0 +1,113 @@
+import collections
+import logging
+import time
+
+
+class ObjectRequests:
+    """Schedules getobject requests so every object is downloaded once.
+
+    Peers announce objects (ihaveobject, mempool and chaintip replies, or a
+    block or orphan that refers to them) and each object is requested from
+    one announcing peer at a time, the one with the fewest requests in
+    flight. If it does not arrive within `timeout` seconds, the next
+    announcing peer is asked. At most `max_per_peer` requests are in flight
+    to one peer; objects whose announcers are all busy wait until a slot
+    frees up. Timeouts and reply times are reported to the PeerManager.
+    """
+    log = logging.getLogger('Requests')
+
+    def __init__(self, node, timeout, max_per_peer):
+        self.node = node
+        self.timeout = timeout
+        self.max_per_peer = max_per_peer
+
+        # Object id -> peer ids that announced it and were not asked yet
+        self.announcers = collections.defaultdict(list)
+        # Object id -> (peer id, timeout handle, time sent)
+        self.inflight = {}
+        self.per_peer = collections.Counter()
+        self.waiting = collections.OrderedDict()
+
+    def __contains__(self, obj_id):
+        return obj_id in self.inflight or obj_id in self.waiting
+
+    def announce(self, peer_id, obj_id):
+        self.announce_all([peer_id], obj_id)
+
+    def announce_all(self, peer_ids, obj_id):
+        """Note that all of `peer_ids` have the object, then schedule it once."""
+        for peer_id in peer_ids:
+            if peer_id not in self.announcers[obj_id]:
+                self.announcers[obj_id].append(peer_id)
+        if obj_id not in self.inflight:
+            self.schedule(obj_id)
+
+    def schedule(self, obj_id):
+        candidates = [
+            peer_id for peer_id in self.announcers[obj_id]
+            if self.per_peer[peer_id] < self.max_per_peer and self.node.server.peers.get(peer_id) is not None
+        ]
+        if not candidates:
+            if self.announcers[obj_id]:
+                self.waiting[obj_id] = None
+            else:
+                self.log.debug('No peer left to ask for %s' % obj_id)
+                self.forget(obj_id)
+            return
+        peer_id = min(candidates, key=lambda candidate: self.per_peer[candidate])
+        self.announcers[obj_id].remove(peer_id)
+        self.waiting.pop(obj_id, None)
+
+        handle = self.node.loop.call_later(self.timeout, self.expire, obj_id, peer_id)
+        self.inflight[obj_id] = (peer_id, handle, time.monotonic())
+        self.per_peer[peer_id] += 1
+        self.node.request_object(peer_id, obj_id)
+
+    def finish(self, obj_id):
+        (peer_id, handle, _) = self.inflight.pop(obj_id)
+        handle.cancel()
+        self.per_peer[peer_id] -= 1
+        if not self.per_peer[peer_id]:
+            del self.per_peer[peer_id]
+        return peer_id
+
+    def forget(self, obj_id):
+        self.announcers.pop(obj_id, None)
+        self.waiting.pop(obj_id, None)
+
+    def received(self, obj_id, peer_id=None):
+        """Note that an object arrived, from whichever peer; returns the reply time if `peer_id` was asked."""
+        elapsed = None
+        if obj_id in self.inflight:
+            if self.inflight[obj_id][0] == peer_id:
+                elapsed = time.monotonic() - self.inflight[obj_id][2]
+            self.finish(obj_id)
+            self.drain()
+        self.forget(obj_id)
+        return elapsed
+
+    def expire(self, obj_id, peer_id):
+        if obj_id not in self.inflight or self.inflight[obj_id][0] != peer_id:
+            return
+        self.log.info('Request for %s to %s timed out' % (obj_id, peer_id))
+        self.node.peer_manager.timed_out(peer_id)
+        self.finish(obj_id)
+        self.schedule(obj_id)
+        self.drain()
+
+    def peer_lost(self, peer_id):
+        for obj_id in [obj_id for (obj_id, (asked, _, _)) in self.inflight.items() if asked == peer_id]:
+            self.finish(obj_id)
+            self.schedule(obj_id)
+        for announcers in self.announcers.values():
+            if peer_id in announcers:
+                announcers.remove(peer_id)
+        self.drain()
+
+    def drain(self):
+        """Request waiting objects whose announcers have free slots again."""
+        if not any(self.per_peer[peer_id] < self.max_per_peer for peer_id in self.node.server.peers):
+            return
+        for obj_id in list(self.waiting):
+            if obj_id in self.waiting:
+                self.schedule(obj_id)
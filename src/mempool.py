@@ -0,0 +1,121 @@
+import collections
+import logging
+
+
+class Mempool:
+    """Valid transactions that are not in a block yet.
+
+    Transactions are indexed by id, in arrival order so parents come before
+    their children, and by the outpoints they spend, so a conflict is found
+    with one lookup. For validation the mempool also acts as a view over the
+    UTxOSet that adds the outputs of mempool transactions; spends by other
+    mempool transactions are deliberately not applied there, so a
+    conflicting transaction is still a valid object, it just does not enter
+    the mempool.
+
+    When the tip advances by a block, its transactions leave the mempool
+    and the transactions conflicting with it are removed with their
+    descendants; the rest of the mempool is left as is. After a chain
+    reorganisation the mempool is rebuilt from the abandoned blocks'
+    transactions followed by its own, keeping those still valid.
+    """
+    log = logging.getLogger('Mempool')
+
+    def __init__(self, utxos):
+        self.utxos = utxos
+        self.txs = collections.OrderedDict()
+        self.spends = {}
+        self.outputs = {}
+
+    def __contains__(self, tx_id):
+        return tx_id in self.txs
+
+    def __len__(self):
+        return len(self.txs)
+
+    def txids(self):
+        return list(self.txs)
+
+    def envelope(self, tx_id):
+        return self.txs.get(tx_id)
+
+    def get(self, tx_id, index):
+        output = self.outputs.get((tx_id, index))
+        return self.utxos.get(tx_id, index) if output is None else output
+
+    def is_spent(self, tx_id, index):
+        return self.utxos.is_spent(tx_id, index)
+
+    def known(self, tx_id):
+        return tx_id in self.txs or self.utxos.known(tx_id)
+
+    def add(self, envelope):
+        """Add a valid transaction unless it conflicts with one already in; True if added."""
+        tx = envelope.obj
+        outpoints = [(inp['outpoint']['txid'], inp['outpoint']['index']) for inp in tx['inputs']]
+        for outpoint in outpoints:
+            if outpoint in self.spends:
+                self.log.info('Tx %s conflicts with %s, not added' % (envelope.id, self.spends[outpoint]))
+                return False
+        self.txs[envelope.id] = envelope
+        for outpoint in outpoints:
+            self.spends[outpoint] = envelope.id
+        for (index, output) in enumerate(tx['outputs']):
+            self.outputs[(envelope.id, index)] = (bytes.fromhex(output['pubkey']), output['value'])
+        return True
+
+    def discard(self, tx_id):
+        envelope = self.txs.pop(tx_id)
+        for inp in envelope.obj['inputs']:
+            outpoint = (inp['outpoint']['txid'], inp['outpoint']['index'])
+            if self.spends.get(outpoint) == tx_id:
+                del self.spends[outpoint]
+        for index in range(len(envelope.obj['outputs'])):
+            self.outputs.pop((tx_id, index), None)
+        return envelope
+
+    def evict(self, tx_id):
+        """Remove a transaction and every mempool transaction built on it."""
+        stack, evicted = [tx_id], 0
+        while stack:
+            tx_id = stack.pop()
+            if tx_id not in self.txs:
+                continue
+            envelope = self.discard(tx_id)
+            evicted += 1
+            for index in range(len(envelope.obj['outputs'])):
+                child = self.spends.get((tx_id, index))
+                if child is not None:
+                    stack.append(child)
+        return evicted
+
+    def confirm(self, txs):
+        """Update the mempool for the (id, transaction) pairs of an accepted block."""
+        confirmed, evicted = 0, 0
+        for (tx_id, tx) in txs:
+            if tx_id in self.txs:
+                # Its outputs are in the UTxOSet now, its children stay
+                self.discard(tx_id)
+                confirmed += 1
+        for (tx_id, tx) in txs:
+            for inp in tx.get('inputs', []):
+                spender = self.spends.get((inp['outpoint']['txid'], inp['outpoint']['index']))
+                if spender is not None:
+                    evicted += self.evict(spender)
+        if confirmed or evicted:
+            self.log.info('%d transactions confirmed, %d conflicting removed, %d left' % (confirmed, evicted, len(self.txs)))
+
+    def reorganised(self, abandoned, accept):
+        """Rebuild the mempool on a new chain from the envelopes of `abandoned` and its own.
+
+        `accept(envelope)` tells whether a transaction is valid on top of the
+        UTxOSet and the mempool rebuilt so far.
+        """
+        envelopes = list(abandoned) + list(self.txs.values())
+        self.txs.clear()
+        self.spends.clear()
+        self.outputs.clear()
+        for envelope in envelopes:
+            if envelope.id not in self.txs and not self.utxos.known(envelope.id) and accept(envelope):
+                self.add(envelope)
+        self.log.info('Rebuilt after a reorganisation, %d of %d transactions kept' % (len(self.txs), len(envelopes)))
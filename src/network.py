@@ -1,141 +1,248 @@
-import asyncore
+import asyncio
 import collections
+import json
 import logging
-import socket
-import queue
-from library.Canonicalize import canonicalize
-
-
-MAX_MESSAGE_LENGTH = 4096
-
-
-class Client(asyncore.dispatcher):
-
-    def __init__(self, host_address, id):
-        asyncore.dispatcher.__init__(self)
-
+import re
+import config
+from .cache import LRUCache
+from library.FastCanonicalize import canonical_length, canonicalize, plain_canonical_length
+
+
+UPPERCASE_ESCAPE = re.compile(rb'\\u[0-9a-fA-F]{0,3}[A-F]')
+OBJECT_PREFIX = b'{"object":'
+OBJECT_SUFFIX = b',"type":"object"}'
+
+
+class FrameTooLong(Exception):
+    pass
+
+
+def encode_message(message):
+    """Return the wire frame of a message, ready to be queued on any number of peers."""
+    frame = canonicalize(message) + b'\n'
+    if len(frame) > config.network.MAX_FRAME_LENGTH:
+        raise ValueError('Message too long')
+    return frame
+
+
+def decode_message(frame):
+    """Parse a frame into (message, raw object bytes).
+
+    For an `object` message that is already canonical, the raw bytes are the
+    exact span of the object inside the frame, so it can be hashed without
+    encoding it again. For anything else they are None.
+
+    Apart from uppercase hex in \\u escapes, any deviation from the canonical
+    form (whitespace, extra escapes, '-0', duplicate keys) only makes a JSON
+    text longer. So a span whose keys are in order and whose length equals
+    the canonical length of what it parses to is canonical.
+    """
+    msg = json.loads(frame)
+    if not (frame.startswith(OBJECT_PREFIX) and frame.endswith(OBJECT_SUFFIX)) or len(msg) != 2:
+        return (msg, None)
+    raw = frame[len(OBJECT_PREFIX):-len(OBJECT_SUFFIX)]
+    if b'\\' not in raw and raw.isascii():
+        length = plain_canonical_length(msg['object'])
+    elif UPPERCASE_ESCAPE.search(raw):
+        return (msg, None)
+    else:
+        length = canonical_length(msg['object'])
+    if length != len(raw):
+        return (msg, None)
+    return (msg, raw)
+
+
+class Framer:
+    """Incremental splitter of a byte stream into newline-terminated frames.
+
+    Incoming data is appended to one bytearray. Complete frames are sliced out
+    through a memoryview, and the consumed head is only dropped once it makes
+    up most of the buffer, so a partial frame is not copied again on every read.
+    """
+
+    def __init__(self, max_frame_length):
+        self.max_frame_length = max_frame_length
+        self.buffer = bytearray()
+        self.start = 0
+        self.scanned = 0
+
+    def feed(self, data):
+        self.buffer += data
+        frames = []
+        while True:
+            end = self.buffer.find(b'\n', self.scanned)
+            if end == -1:
+                self.scanned = len(self.buffer)
+                if self.scanned - self.start > self.max_frame_length:
+                    raise FrameTooLong('Frame exceeds %d bytes' % self.max_frame_length)
+                break
+            if end - self.start > self.max_frame_length:
+                raise FrameTooLong('Frame exceeds %d bytes' % self.max_frame_length)
+            if end > self.start:
+                with memoryview(self.buffer) as view:
+                    frames.append(bytes(view[self.start:end]))
+            self.start = self.scanned = end + 1
+
+        if self.start > len(self.buffer) // 2:
+            del self.buffer[:self.start]
+            self.scanned -= self.start
+            self.start = 0
+        return frames
+
+
+class Peer(asyncio.Protocol):
+    """A connection to another node, either dialed by us or accepted by the Server.
+
+    Everything runs on the event loop: complete frames are handed to the
+    server's handler as soon as they are read. Outgoing frames are queued in
+    the outbox and written together once per loop iteration; the transport
+    buffers whatever the socket does not take. Once the transport holds more
+    than WRITE_HIGH_WATER bytes the outbox stops draining, and a peer whose
+    outbox grows past OUTBOX_LIMIT bytes is disconnected.
+
+    `outbound` tells dialed peers from accepted ones, `address` is the
+    advertised address a dialed peer was reached at, and `useful`, `errors`,
+    `timeouts` and `latency` feed the PeerManager's score.
+
+    `known` holds the ids of the last KNOWN_INVENTORY_ENTRIES objects the
+    peer announced, sent or was sent, so they are not announced to it again.
+    """
+
+    def __init__(self, server, id=None):
+        self.server = server
         self.id = id
         self.log = logging.getLogger('(%s)' % self.id)
 
-        self.buffer = queue.Queue()
+        self.outbound = id is not None
+        self.address = None
+        self.useful, self.errors, self.timeouts, self.latency = 0, 0, 0, 0.0
+
+        self.transport = None
+        self.framer = Framer(config.network.MAX_FRAME_LENGTH)
         self.hello_send, self.hello_recv = False, False
 
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.known = LRUCache(config.network.KNOWN_INVENTORY_ENTRIES)
         self.outbox = collections.deque()
+        self.outbox_bytes = 0
+        self.flush_scheduled = False
+        self.paused = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.transport.set_write_buffer_limits(high=config.network.WRITE_HIGH_WATER)
+        if self.id is None:
+            (host, port) = transport.get_extra_info('peername')[:2]
+            self.id = ':'.join([host, str(port)])
+            self.log = logging.getLogger('(%s)' % self.id)
+            self.server.peers[self.id] = self
+            self.server.log.info('Accepted peer %s' % self.id)
+            if not self.server.handler.accept_peer(self):
+                self.close()
+                return
+        else:
+            self.log.info('Connected to peer')
 
-        self.log.info('Connecting to peer')
-        try:
-            self.connect(host_address)
-        except OSError:
-            self.log.debug('OSError in Connection')
-            return
-
-    def is_live(self):
-        return (self.hello_send and self.hello_recv)
-
-    def say(self, message):
-        self.log.info('Sending %s' % message)
-        self.outbox.append(canonicalize(message) + b'\n')
+        self.flush()
 
-    def handle_write(self):
-        if not self.outbox:
-            return
-        message = self.outbox.popleft()
-        if len(message) > MAX_MESSAGE_LENGTH:
-            raise ValueError('Message too long')
-        self.send(message)
+    def connection_lost(self, exc):
+        if exc is not None:
+            self.log.debug('Connection lost: %s' % exc)
+        self.transport = None
+        self.hello_send = False
+        self.server.handler.remove_peer(self)
 
-    def handle_read(self):
+    def data_received(self, data):
         try:
-            message = self.recv(MAX_MESSAGE_LENGTH)
-            if message == b'':
-                self.close()
-                self.hello_send = False
-            else:
-                self.buffer.put(message)
-        except BlockingIOError:
-            self.log.debug('IO Error')
-            self.close()
-            self.hello_send = False
-        except OSError:
-            self.log.debug('OS Error')
+            frames = self.framer.feed(data)
+        except FrameTooLong as error:
+            self.log.error('Closing connection: %s' % error)
             self.close()
-            self.hello_send = False
-
-
-class RemoteClient(asyncore.dispatcher):
-    def __init__(self, socket, host):
-        asyncore.dispatcher.__init__(self, socket)
-        self.host = host
-
-        self.outbox = collections.deque()
+            return
+        if frames:
+            self.server.handler.handle_frames(self, frames)
 
-        self.buffer = queue.Queue()
+    def is_live(self):
+        return (self.hello_send and self.hello_recv)
 
-        self.hello_send, self.hello_recv = False, False
+    def is_closing(self):
+        return self.transport is not None and self.transport.is_closing()
 
     def say(self, message):
-        self.outbox.append(canonicalize(message) + b'\n')
+        self.log.info('Sending %s' % message)
+        self.write(encode_message(message))
 
-    def handle_read(self):
-        try:
-            message = self.recv(MAX_MESSAGE_LENGTH)
-            self.buffer.put(message)
-        except BlockingIOError:
-            self.log.debug('IO Error')
+    def write(self, data):
+        self.outbox.append(data)
+        self.outbox_bytes += len(data)
+        if self.outbox_bytes > config.network.OUTBOX_LIMIT:
+            self.log.error('Outbox over %d bytes, closing connection' % config.network.OUTBOX_LIMIT)
             self.close()
-        except OSError:
-            self.log.debug('OS Error')
-            self.close()
-
-    def handle_write(self):
-        if not self.outbox:
             return
-        message = self.outbox.popleft()
-        if len(message) > MAX_MESSAGE_LENGTH:
-            raise ValueError('Message too long')
-        self.send(message)
-
-
-class Host(asyncore.dispatcher):
-    log = logging.getLogger('Server')
-
-    def __init__(self, host, port, server):
-        asyncore.dispatcher.__init__(self)
+        if self.transport is not None and not self.paused and not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.server.loop.call_soon(self.flush)
 
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.bind((host, port))
-        self.listen(1)
-
-        self.log.info('Server is listening on: %s' % str((host, port)))
+    def flush(self):
+        self.flush_scheduled = False
+        if self.transport is None or self.paused or not self.outbox:
+            return
+        frames = list(self.outbox)
+        self.outbox.clear()
+        self.outbox_bytes = 0
+        self.transport.writelines(frames)
 
-        self.server = server
+    def pause_writing(self):
+        self.paused = True
 
-    def handle_accept(self):
-        socket, (host, port) = self.accept()
-        peer_id = ':'.join([host, str(port)])
-        self.server.peers[peer_id] = RemoteClient(socket, self)
-        self.log.info('Accepted peer %s' % str((host, port)))
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
 
-    def handle_read(self):
-        self.log.info('Received message: %s', self.read())
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
 
 
 class Server:
-    def __init__(self, host, port):
+    def __init__(self, host, port, loop, handler):
         self.log = logging.getLogger('Server')
         self.peers = {}
-        self.host = Host(host, port, self)
+        self.host, self.port = host, port
+        self.loop = loop
+        self.handler = handler
+        self.listener = None
 
         self.log.info('Server set up')
 
+    async def start(self):
+        self.listener = await self.loop.create_server(lambda: Peer(self), self.host, self.port)
+        self.log.info('Server is listening on: %s' % str((self.host, self.port)))
+
     def connect_to_peer(self, peer_id):
         (host, port) = peer_id.split(':')
-        self.peers[peer_id] = Client((host, int(port)), peer_id)
+        peer = Peer(self, peer_id)
+        self.peers[peer_id] = peer
+        self.loop.create_task(self.dial(peer, host, int(port)))
         return True
 
-    def broadcast(self, message):
-        self.log.info('Broadcasting message: %s', message)
-        for (peer_id, peer) in self.peers.items():
-            if peer.is_live():
-                peer.say(message)
+    async def dial(self, peer, host, port):
+        peer.log.info('Connecting to peer')
+        try:
+            await asyncio.wait_for(
+                self.loop.create_connection(lambda: peer, host, port),
+                config.network.CONNECT_TIMEOUT
+            )
+        except (OSError, asyncio.TimeoutError) as error:
+            peer.log.debug('Could not connect: %r' % error)
+            peer.connection_lost(None)
+
+    def broadcast_frame(self, frame, obj_id=None):
+        """Queue a frame on every live peer, skipping those that know `obj_id`."""
+        for (peer_id, peer) in list(self.peers.items()):
+            if not peer.is_live():
+                continue
+            if obj_id is not None:
+                if obj_id in peer.known:
+                    continue
+                peer.known.put(obj_id, True)
+            peer.write(frame)
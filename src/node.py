@@ -1,94 +1,182 @@
+import asyncio
+import collections
 import json
-import asyncore
-import socket
 import re
-import threading
-from time import sleep
-from .network import Server
+from .network import Server, decode_message, encode_message
 from .database import PenguinDB
-from .blockchain import parse_object
+from .cache import LRUCache
+from .utxo import UTxOSet
+from .chain import BlockIndex
+from .pipeline import BlockPipeline
+from .orphans import OrphanPool
+from .mempool import Mempool
+from .inflight import ObjectRequests
+from .sync import InitialSync
+from .resolver import Resolver
+from .peers import PeerManager
+from .verify import DeferredVerifier, SignatureVerifier
+from .blockchain import OBJECT_ID, Envelope, Transaction, accept_transaction, parse_object
 from .exceptions import BlockhainError
 import config
 import logging
+from hashlib import sha256
 from nacl.signing import SigningKey
 
 
+# Messages that are the same for every peer are encoded once and shared
+HELLO_FRAME = encode_message({
+    'type': 'hello',
+    'version': config.node.VERSION,
+    'agent': config.node.AGENT
+})
+GETPEERS_FRAME = encode_message({'type': 'getpeers'})
+GETMEMPOOL_FRAME = encode_message({'type': 'getmempool'})
+GETCHAINTIP_FRAME = encode_message({'type': 'getchaintip'})
+
+
 class Node:
     log = logging.getLogger('Node')
 
     def __init__(self, host, port, db_path):
         self.db = PenguinDB(db_path)
+        self.validated = LRUCache(config.node.VALIDATED_CACHE_ENTRIES)
+        self.chain = BlockIndex(self.db, db_path + '.index')
+        self.pipeline = BlockPipeline(self)
+        self.orphans = OrphanPool(
+            config.node.ORPHAN_MAX_ENTRIES,
+            config.node.ORPHAN_MAX_BYTES,
+            config.node.ORPHAN_EXPIRY
+        )
+        self.adoptable, self.adopting = collections.deque(), False
+        self.requests = ObjectRequests(self, config.node.REQUEST_TIMEOUT, config.node.REQUEST_MAX_PER_PEER)
+        self.sync = InitialSync(self)
+        self.utxos = UTxOSet(
+            self.db,
+            db_path + '.utxo',
+            config.node.UTXO_SNAPSHOT_INTERVAL,
+            config.node.REORG_MAX_DEPTH
+        )
+        self.utxos.replay(self.chain)
+        self.mempool = Mempool(self.utxos)
+        # Ids of gossiped transactions whose signatures are being verified
+        self.verifying = set()
+        self.verifier = SignatureVerifier(
+            config.node.VERIFY_WORKERS,
+            config.node.VERIFY_MODE,
+            config.node.VERIFY_BATCH_SIZE
+        )
 
         self.server_host, self.server_port = host, port
-        self.server = Server(host, port)
-
-        t1 = threading.Thread(target=self.read_buffer)
-        t1.start()
-
-        if self.db.get('peers') == []:
-            self.log.info('Using hardcoded peers')
-            self.db.set('peers', [config.network.PEER_HOST + ':' + str(config.network.PEER_PORT)])
-
-        for peer_id in self.db.get('peers'):
-            self.connect_to_peer(peer_id)
-
-        self.connected_peers = []
+        self.loop = asyncio.new_event_loop()
+        self.resolver = Resolver(
+            self.loop,
+            config.network.DNS_TTL,
+            config.network.DNS_NEGATIVE_TTL,
+            config.network.DNS_TIMEOUT,
+            config.network.DNS_CACHE_ENTRIES
+        )
+        self.server = Server(host, port, self.loop, self)
+        # Addresses that reach this node, so it never dials itself
+        self.own_hosts = {'127.0.0.1', '0.0.0.0'}
+        try:
+            self.own_hosts.add(self.loop.run_until_complete(self.resolver.resolve(host)))
+        except OSError as error:
+            self.log.error('Could not resolve own host %s: %s' % (host, error))
+        self.peer_manager = PeerManager(self)
+        self.loop.call_soon(self.peer_manager.maintain)
 
         self.privkey = SigningKey(config.blockchain.ACCOUNT_SEED)
         self.pubkey = self.privkey.verify_key
 
-        asyncore.loop()
-
-    def connect_to_peer(self, peer_id):
-        (hostname, port) = peer_id.split(':')
-        host = socket.gethostbyname(hostname)
-        peer_id = ':'.join([host, port])
+        self.loop.run_until_complete(self.server.start())
+        try:
+            self.loop.run_forever()
+        finally:
+            self.verifier.shutdown()
+            self.utxos.close()
+            self.db.close()
+            self.chain.close()
+
+    def connect_to_peer(self, address):
+        """Resolve and dial a peer in the background; raises ValueError if the address is malformed."""
+        (hostname, port) = address.split(':')
+        if not 0 < int(port) < 65536:
+            raise ValueError('Invalid port in %s' % address)
+        self.loop.create_task(self.resolve_and_connect(address, hostname, port))
+
+    async def resolve_and_connect(self, address, hostname, port):
+        try:
+            try:
+                host = await self.resolver.resolve(hostname)
+            except OSError as error:
+                self.log.debug('Peer %s is unreachable: %s' % (hostname, error))
+                self.peer_manager.failed(address)
+                return
+            peer_id = ':'.join([host, port])
 
-        if peer_id in self.server.peers.keys() or len(self.server.peers.keys()) == 5:
-            self.log.debug('Peer %s already in list' % peer_id)
-            return
+            if int(port) == self.server_port and host in self.own_hosts:
+                self.log.debug('Peer %s is this node' % address)
+                self.peer_manager.forget(address)
+                return
+            if peer_id in self.server.peers:
+                self.log.debug('Peer %s already in list' % peer_id)
+                return
 
-        self.log.info('Connecting to peer %s' % peer_id)
-        if self.server.connect_to_peer(peer_id):
-            self.send_hello(peer_id)
+            self.log.info('Connecting to peer %s' % peer_id)
+            if self.server.connect_to_peer(peer_id):
+                self.server.peers[peer_id].address = address
+                self.send_hello(peer_id)
+        finally:
+            self.peer_manager.dialing.discard(address)
 
     def send_hello(self, peer_id):
         self.log.info('Sending hello to %s' % peer_id)
 
-        msg = {
-            'type': 'hello',
-            'version': config.node.VERSION,
-            'agent': config.node.AGENT
-        }
-
         peer = self.server.peers[peer_id]
-        peer.say(msg)
+        peer.write(HELLO_FRAME)
         peer.hello_send = True
 
     def send_peers(self, peer_id):
         self.log.info('Sending peers to %s' % peer_id)
 
         msg = {'type': 'peers'}
-        msg['peers'] = list(self.server.peers.keys())
+        msg['peers'] = self.peer_manager.shareable()
 
         self.server.peers[peer_id].say(msg)
 
     def get_peers(self, peer_id):
         self.log.info('Requesting peers from %s' % peer_id)
 
-        msg = {'type': 'getpeers'}
-        self.server.peers[peer_id].say(msg)
+        self.server.peers[peer_id].write(GETPEERS_FRAME)
 
     def get_mempool(self, peer_id):
         self.log.info('Requesting mempool from %s' % peer_id)
 
-        msg = {'type': 'getmempool'}
-        self.server.peers[peer_id].say(msg)
+        self.server.peers[peer_id].write(GETMEMPOOL_FRAME)
 
     def get_chaintip(self, peer_id):
         self.log.info('Requesting chaintip from %s' % peer_id)
 
-        msg = {'type': 'getchaintip'}
+        self.server.peers[peer_id].write(GETCHAINTIP_FRAME)
+
+    def send_chaintip(self, peer_id):
+        if self.chain.tip is None:
+            return
+        self.log.info('Sending chaintip to %s' % peer_id)
+
+        msg = {
+            'type': 'chaintip',
+            'blockid': self.chain.tip
+        }
+        self.server.peers[peer_id].say(msg)
+
+    def send_mempool(self, peer_id):
+        self.log.info('Sending mempool to %s' % peer_id)
+
+        msg = {
+            'type': 'mempool',
+            'txids': self.mempool.txids()
+        }
         self.server.peers[peer_id].say(msg)
 
     def broadcast_object(self, obj_id):
@@ -98,14 +186,28 @@ class Node:
             'type': 'ihaveobject',
             'objectid': obj_id
         }
-        self.server.broadcast(msg)
+        self.server.broadcast_frame(encode_message(msg), obj_id)
 
-    def send_object(self, peer_id, obj):
-        self.log.info('Sending message %s to %s' % (str(obj), peer_id))
+    def send_object(self, peer_id, obj_id):
+        # Only object ids, never metadata keys such as 'peers'
+        if not isinstance(obj_id, str) or not OBJECT_ID.fullmatch(obj_id):
+            self.log.info('Not sending %r to %s, not an object id' % (obj_id, peer_id))
+            return
+        raw = self.db.get_raw(obj_id)
+        if raw is None:
+            return
+        self.log.info('Sending object %s to %s' % (obj_id, peer_id))
+        self.server.peers[peer_id].known.put(obj_id, True)
+
+        # Objects stored from an Envelope are canonical, so the message can be
+        # spliced around the stored bytes; "object" sorts before "type"
+        if sha256(raw).hexdigest() == obj_id:
+            self.server.peers[peer_id].write(b'{"object":' + raw + b',"type":"object"}\n')
+            return
 
         msg = {
             'type': 'object',
-            'object': obj
+            'object': self.db.get(obj_id)
         }
         self.server.peers[peer_id].say(msg)
 
@@ -127,31 +229,106 @@ class Node:
         }
         self.server.peers[peer_id].say(msg)
 
-    def remove_peer(self, peer):
-        self.server.peers[peer.id] = None
-
-    def read_buffer(self):
-        while True:
-            for (_, peer) in list(self.server.peers.items()):
-                if peer is None:
-                    continue
-                while not peer.buffer.empty():
-                    data = peer.buffer.get()
-
-                    if data == b'':
-                        self.remove_peer(peer)
-                        break
+    def hold_orphan(self, envelope, peer_id, missing):
+        for obj_id in self.orphans.add(envelope, peer_id, missing):
+            self.requests.announce(peer_id, obj_id)
+
+    def adopt_orphans(self, obj_id):
+        """Validate again the orphans that were waiting for `obj_id`.
+
+        Adopting an orphan can make more orphans adoptable; those are queued
+        rather than validated recursively.
+        """
+        self.adoptable.append(obj_id)
+        if self.adopting:
+            return
+        self.adopting = True
+        try:
+            while self.adoptable:
+                for (envelope, peer_id) in self.orphans.resolve(self.adoptable.popleft()):
                     try:
-                        datalist = data.decode('utf-8').split('\n')
-                        for d in datalist:
-                            if d:
-                                msg = json.loads(d)
-                                self.parse_msg(msg, peer)
-                    except json.decoder.JSONDecodeError:
-                        self.log.error('Error decoding json data from peer %s: %s' % (peer.id, data))
-            sleep(1)
-
-    def parse_msg(self, msg, peer):
+                        parse_object(envelope, self, peer_id)
+                    except BlockhainError as error_msg:
+                        self.log.error(error_msg)
+                        if self.server.peers.get(peer_id) is not None:
+                            self.send_error(peer_id, str(error_msg))
+        finally:
+            self.adopting = False
+
+    def verify_transaction(self, envelope, peer_id, coinbase, jobs):
+        self.verifying.add(envelope.id)
+        self.loop.create_task(self.finish_transaction(envelope, peer_id, coinbase, jobs))
+
+    async def finish_transaction(self, envelope, peer_id, coinbase, jobs):
+        """Verify a gossiped transaction's signatures on the verifier pool, then accept it."""
+        try:
+            bad = await asyncio.wait_for(
+                self.loop.run_in_executor(None, self.verifier.verify, jobs),
+                config.node.BLOCK_VERIFY_TIMEOUT
+            )
+        except asyncio.TimeoutError:
+            self.log.error('Timed out verifying tx %s' % envelope.id)
+            return
+        finally:
+            self.verifying.discard(envelope.id)
+
+        peer = self.server.peers.get(peer_id)
+        if bad is not None:
+            error_message = 'Invalid signature for tx %s, input %d' % (envelope.id, bad)
+            self.log.error(error_message)
+            if peer is not None:
+                self.peer_manager.misbehaved(peer)
+                self.send_error(peer_id, error_message)
+            return
+        # A block may have spent its inputs meanwhile
+        try:
+            if not Transaction(envelope, self.mempool, coinbase, DeferredVerifier()).valid:
+                return
+        except BlockhainError as error_msg:
+            self.log.info('Tx %s is no longer valid: %s' % (envelope.id, error_msg))
+            return
+        with self.db.batch():
+            accept_transaction(envelope, self, coinbase)
+
+    def has_object(self, obj_id):
+        return (
+            obj_id in self.mempool
+            or obj_id in self.chain
+            or obj_id in self.orphans
+            or obj_id in self.pipeline.coinbases
+            or obj_id in self.verifying
+            or bool(self.db.get(obj_id))
+        )
+
+    def accept_peer(self, peer):
+        return self.peer_manager.admit(peer)
+
+    def remove_peer(self, peer):
+        if self.server.peers.get(peer.id) is peer:
+            del self.server.peers[peer.id]
+        self.peer_manager.lost(peer)
+        self.requests.peer_lost(peer.id)
+
+    def handle_frames(self, peer, frames):
+        with self.db.batch():
+            for data in frames:
+                try:
+                    (msg, raw) = decode_message(data)
+                    self.parse_msg(msg, peer, raw)
+                except (json.decoder.JSONDecodeError, UnicodeDecodeError):
+                    self.log.error('Error decoding json data from peer %s: %s' % (peer.id, data))
+                    self.peer_manager.misbehaved(peer)
+                except (KeyError, TypeError, ValueError) as error:
+                    error_message = 'Malformed message: %r' % error
+                    self.log.error('%s from peer %s: %s' % (error_message, peer.id, data))
+                    self.peer_manager.misbehaved(peer)
+                    if not peer.hello_recv:
+                        peer.close()
+                    elif not peer.is_closing():
+                        self.send_error(peer.id, error_message)
+        self.utxos.maybe_snapshot()
+
+    def parse_msg(self, msg, peer, raw=None):
         if not peer.hello_recv:
             if not all([
                 msg['type'] == 'hello',
@@ -165,10 +342,10 @@ class Node:
             if not peer.hello_send:
                 self.send_hello(peer.id)
 
-            self.connected_peers.append(peer.id)
-            self.db.set('peers', self.connected_peers)
+            self.peer_manager.connected(peer)
             self.get_peers(peer.id)
-            self.request_object(peer.id, config.blockchain.GENESIS_ID)
+            if not self.has_object(config.blockchain.GENESIS_ID):
+                self.requests.announce(peer.id, config.blockchain.GENESIS_ID)
             self.get_mempool(peer.id)
             self.get_chaintip(peer.id)
         elif msg['type'] == 'getpeers':
@@ -176,34 +353,51 @@ class Node:
             self.send_peers(peer.id)
         elif msg['type'] == 'peers':
             self.log.info('Received peers from %s' % peer.id)
-            peer_list = msg['peers']
-            for peer in peer_list:
+            for address in msg['peers'][:config.network.ADDRBOOK_MAX_ENTRIES]:
                 try:
-                    self.connect_to_peer(peer)
-                except (AttributeError, ValueError, socket.gaierror):
-                    self.log.debug('Peer is malformed %s' % peer)
+                    self.peer_manager.learn(address)
+                except (AttributeError, ValueError):
+                    self.log.debug('Peer is malformed %s' % address)
+            self.peer_manager.top_up()
         elif msg['type'] == 'ihaveobject':
             obj_id = msg['objectid']
             self.log.info('Peer %s has object with id %s' % (peer.id, obj_id))
-            self.request_object(peer.id, obj_id)
+            peer.known.put(obj_id, True)
+            if not self.has_object(obj_id):
+                self.requests.announce(peer.id, obj_id)
         elif msg['type'] == 'object':
             try:
-                parse_object(msg['object'], self, peer.id)
+                envelope = Envelope(msg['object'], raw)
+                peer.known.put(envelope.id, True)
+                fresh = not self.has_object(envelope.id)
+                elapsed = self.requests.received(envelope.id, peer.id)
+                if elapsed is not None:
+                    self.peer_manager.replied(peer, elapsed)
+                if not self.pipeline.received(envelope) and not self.sync.received(envelope):
+                    parse_object(envelope, self, peer.id)
+                if fresh:
+                    self.peer_manager.delivered(peer)
             except BlockhainError as error_msg:
                 self.log.error(error_msg)
-                self.send_error(peer.id, error_msg)
+                self.peer_manager.misbehaved(peer)
+                self.send_error(peer.id, str(error_msg))
         elif msg['type'] == 'getobject':
-            obj_id = msg['objectid']
-            obj = self.db.get(obj_id)
-            if obj:
-                self.send_object(peer.id, obj)
+            self.send_object(peer.id, msg['objectid'])
+        elif msg['type'] == 'getmempool':
+            self.send_mempool(peer.id)
         elif msg['type'] == 'mempool':
             self.log.info('Got mempool of %s: %s' % (peer.id, str(msg['txids'])))
             for tx_id in msg['txids']:
-                self.request_object(peer.id, tx_id)
+                peer.known.put(tx_id, True)
+                if not self.has_object(tx_id):
+                    self.requests.announce(peer.id, tx_id)
+        elif msg['type'] == 'getchaintip':
+            self.send_chaintip(peer.id)
         elif msg['type'] == 'chaintip':
             self.log.info('Got chaintip id %s' % msg['blockid'])
-            self.request_object(peer.id, msg['blockid'])
+            peer.known.put(msg['blockid'], True)
+            if not self.has_object(msg['blockid']) and not self.sync.start(peer.id, msg['blockid']):
+                self.requests.announce(peer.id, msg['blockid'])
         elif msg['type'] == 'error':
             self.log.error('Got error message from %s: %s' % (peer.id, msg['error']))
         else:
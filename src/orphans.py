@@ -0,0 +1,78 @@
+import collections
+import logging
+import time
+
+
+class OrphanPool:
+    """Objects that arrived before an object they depend on.
+
+    Orphans are indexed by every missing dependency, so when a dependency is
+    accepted exactly the objects waiting for it are handed back for
+    validation. The pool holds at most `max_entries` objects and `max_bytes`
+    of their canonical encoding; the oldest are evicted first, and any orphan
+    older than `expiry` seconds is dropped.
+    """
+    log = logging.getLogger('Orphans')
+
+    def __init__(self, max_entries, max_bytes, expiry):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.expiry = expiry
+
+        # Object id -> (envelope, peer id, missing ids, time added), oldest first
+        self.orphans = collections.OrderedDict()
+        self.by_dependency = collections.defaultdict(set)
+        self.bytes = 0
+
+    def __contains__(self, obj_id):
+        return obj_id in self.orphans
+
+    def __len__(self):
+        return len(self.orphans)
+
+    def add(self, envelope, peer_id, missing):
+        """Keep an orphan until everything in `missing` is accepted.
+
+        Returns the dependencies no other orphan was waiting for yet, which
+        are the ones worth requesting.
+        """
+        self.expire()
+        if envelope.id in self.orphans:
+            self.remove(envelope.id)
+        new = [dep_id for dep_id in missing if dep_id not in self.by_dependency]
+        self.orphans[envelope.id] = (envelope, peer_id, set(missing), time.monotonic())
+        self.bytes += len(envelope.raw)
+        for dep_id in missing:
+            self.by_dependency[dep_id].add(envelope.id)
+        self.log.info('Holding %s until %d objects arrive' % (envelope.id, len(missing)))
+
+        while len(self.orphans) > self.max_entries or self.bytes > self.max_bytes:
+            evicted = next(iter(self.orphans))
+            self.log.debug('Evicting orphan %s' % evicted)
+            self.remove(evicted)
+        return new
+
+    def remove(self, obj_id):
+        (envelope, peer_id, missing, _) = self.orphans.pop(obj_id)
+        self.bytes -= len(envelope.raw)
+        for dep_id in missing:
+            children = self.by_dependency[dep_id]
+            children.discard(obj_id)
+            if not children:
+                del self.by_dependency[dep_id]
+        return (envelope, peer_id)
+
+    def resolve(self, dep_id):
+        """Remove and return (envelope, peer id) of the orphans waiting for `dep_id`."""
+        if dep_id not in self.by_dependency:
+            return []
+        return [self.remove(obj_id) for obj_id in list(self.by_dependency[dep_id])]
+
+    def expire(self):
+        deadline = time.monotonic() - self.expiry
+        while self.orphans:
+            (obj_id, (_, _, _, added)) = next(iter(self.orphans.items()))
+            if added > deadline:
+                break
+            self.log.debug('Orphan %s expired' % obj_id)
+            self.remove(obj_id)
@@ -0,0 +1,175 @@
+import logging
+import time
+import config
+
+
+class PeerManager:
+    """Decides which peers the node connects to and keeps.
+
+    The address book maps advertised `host:port` addresses to
+    [last seen, consecutive failures, last attempt]. It holds at most
+    ADDRBOOK_MAX_ENTRIES addresses, dropping the most failed and longest
+    unseen first, and is saved under the `addrbook` key on every maintenance
+    round in which it changed.
+
+    Every PEER_MAINTENANCE_INTERVAL seconds peers scoring below
+    PEER_MIN_SCORE are dropped, the worst outbound peer is replaced if it
+    scores below zero and another address is available, and new addresses
+    are dialed, with exponential backoff after failures, until MAX_OUTBOUND
+    outbound peers are connected. Inbound connections beyond MAX_INBOUND
+    replace the worst inbound peer if it scores below zero and are refused
+    otherwise.
+
+    A peer earns a point for every new object it delivers and loses points
+    for invalid objects, requests that time out and slow replies.
+    """
+    log = logging.getLogger('Peers')
+
+    ERROR_WEIGHT = 10
+    TIMEOUT_WEIGHT = 2
+    LATENCY_WEIGHT = 5
+    LATENCY_SMOOTHING = 0.2
+
+    def __init__(self, node):
+        self.node = node
+        self.addresses = {}
+        self.dialing = set()
+        self.dirty = False
+        self.load()
+
+    def load(self):
+        for (address, entry) in (self.node.db.get('addrbook') or {}).items():
+            self.addresses[address] = entry
+        if not self.addresses:
+            self.log.info('Using hardcoded peers')
+            for address in (self.node.db.get('peers') or []) + [
+                config.network.PEER_HOST + ':' + str(config.network.PEER_PORT)
+            ]:
+                self.learn(address)
+
+    def save(self):
+        if self.dirty:
+            self.node.db.set('addrbook', self.addresses)
+            self.dirty = False
+
+    def learn(self, address):
+        """Add an address advertised by a peer; raises ValueError if it is malformed."""
+        (host, port) = address.split(':')
+        if not host or not 0 < int(port) < 65536:
+            raise ValueError('Malformed address %s' % address)
+        if address in self.addresses:
+            return
+        self.addresses[address] = [0, 0, 0]
+        self.dirty = True
+        while len(self.addresses) > config.network.ADDRBOOK_MAX_ENTRIES:
+            worst = max(self.addresses, key=lambda known: (self.addresses[known][1], -self.addresses[known][0]))
+            del self.addresses[worst]
+
+    def shareable(self):
+        """Addresses worth passing on in a peers message."""
+        seen = [address for (address, entry) in self.addresses.items() if entry[0] and not entry[1]]
+        seen.sort(key=lambda address: -self.addresses[address][0])
+        return seen[:config.network.PEERS_SHARED]
+
+    def score(self, peer):
+        return (
+            peer.useful
+            - self.ERROR_WEIGHT * peer.errors
+            - self.TIMEOUT_WEIGHT * peer.timeouts
+            - self.LATENCY_WEIGHT * peer.latency
+        )
+
+    def live_peers(self, outbound):
+        return [peer for peer in self.node.server.peers.values() if peer.outbound == outbound]
+
+    def admit(self, peer):
+        """Decide whether to keep a new inbound connection."""
+        inbound = self.live_peers(False)
+        if len(inbound) <= config.network.MAX_INBOUND:
+            return True
+        others = [other for other in inbound if other is not peer]
+        if not others:
+            self.log.info('Refusing inbound peer %s, no inbound slots' % peer.id)
+            return False
+        worst = min(others, key=self.score)
+        if self.score(worst) < 0:
+            self.log.info('Replacing inbound peer %s with %s' % (worst.id, peer.id))
+            worst.close()
+            return True
+        self.log.info('Refusing inbound peer %s, already %d inbound' % (peer.id, len(others)))
+        return False
+
+    def connected(self, peer):
+        if peer.address is not None and peer.address in self.addresses:
+            self.addresses[peer.address][0] = int(time.time())
+            self.addresses[peer.address][1] = 0
+            self.dirty = True
+
+    def forget(self, address):
+        if self.addresses.pop(address, None) is not None:
+            self.dirty = True
+
+    def failed(self, address):
+        if address in self.addresses:
+            self.addresses[address][1] += 1
+            self.dirty = True
+
+    def lost(self, peer):
+        if peer.outbound and not peer.hello_recv:
+            self.failed(peer.address)
+
+    def delivered(self, peer):
+        peer.useful += 1
+
+    def misbehaved(self, peer):
+        peer.errors += 1
+
+    def timed_out(self, peer_id):
+        peer = self.node.server.peers.get(peer_id)
+        if peer is not None:
+            peer.timeouts += 1
+
+    def replied(self, peer, elapsed):
+        peer.latency += self.LATENCY_SMOOTHING * (elapsed - peer.latency)
+
+    def candidates(self):
+        now = time.time()
+        dialed = {peer.address for peer in self.node.server.peers.values()} | self.dialing
+        ready = [
+            address for (address, (_, failures, attempt)) in self.addresses.items()
+            if address not in dialed and attempt + config.network.PEER_RETRY_BASE * (2 ** min(failures, 10)) <= now
+        ]
+        ready.sort(key=lambda address: (self.addresses[address][1], -self.addresses[address][0]))
+        return ready
+
+    def dial(self, address):
+        self.addresses[address][2] = int(time.time())
+        self.dirty = True
+        self.dialing.add(address)
+        self.node.connect_to_peer(address)
+
+    def outbound(self):
+        return len([peer for peer in self.live_peers(True) if not peer.is_closing()]) + len(self.dialing)
+
+    def top_up(self):
+        """Dial the best addresses until MAX_OUTBOUND outbound peers are connected or dialing."""
+        for address in self.candidates()[:max(0, config.network.MAX_OUTBOUND - self.outbound())]:
+            self.dial(address)
+
+    def maintain(self):
+        for peer in list(self.node.server.peers.values()):
+            if self.score(peer) < config.network.PEER_MIN_SCORE:
+                self.log.info('Dropping peer %s scoring %.1f' % (peer.id, self.score(peer)))
+                self.failed(peer.address)
+                peer.close()
+
+        outbound = [peer for peer in self.live_peers(True) if not peer.is_closing()]
+        if self.outbound() >= config.network.MAX_OUTBOUND and outbound and self.candidates():
+            worst = min(outbound, key=self.score)
+            if self.score(worst) < 0:
+                self.log.info('Replacing outbound peer %s scoring %.1f' % (worst.id, self.score(worst)))
+                worst.close()
+        self.top_up()
+
+        self.save()
+        self.node.loop.call_later(config.network.PEER_MAINTENANCE_INTERVAL, self.maintain)
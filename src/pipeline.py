@@ -0,0 +1,299 @@
+import asyncio
+import logging
+import config
+from .blockchain import Envelope, Transaction
+from .cache import LRUCache
+from .chain import block_work
+from .exceptions import BlockhainError
+from .utxo import UTxOView
+from .verify import DeferredVerifier
+
+
+class BlockPipeline:
+    """Validates blocks whose header already passed, one task per block.
+
+    Every block goes through the same stages: its missing transactions are
+    requested from all live peers at once, then it waits for its parent to be
+    accepted, then the signatures of all its new transactions are verified in
+    one batch on the verifier pool, and finally the transactions, the block
+    and its index entry are committed together. Stages are bounded by the
+    BLOCK_*_TIMEOUT settings. Blocks run concurrently, so a slow download
+    holds up only that block and its descendants.
+
+    Only blocks extending the tip are validated and applied to the UTxOSet.
+    A block on a side branch is stored and indexed, and its fetched
+    transactions are kept for the REORG_MAX_DEPTH latest such blocks. When
+    a side branch gets more work than the main chain, the main chain blocks
+    above the fork are undone and the branch is validated and applied
+    instead; if any of its blocks is invalid the main chain is restored. A
+    reorganisation deeper than the available undo data is refused.
+    """
+    log = logging.getLogger('Pipeline')
+
+    def __init__(self, node):
+        self.node = node
+        self.pending = {}
+        # Transaction id -> [future, number of blocks waiting for it]
+        self.waiting = {}
+        # Side branch block id -> its fetched transaction envelopes by id
+        self.side = LRUCache(config.node.REORG_MAX_DEPTH)
+        # Coinbase transaction id -> envelope, for blocks that have not arrived yet
+        self.coinbases = LRUCache(config.node.PENDING_COINBASE_ENTRIES)
+
+    def __contains__(self, block_id):
+        return block_id in self.pending
+
+    def __len__(self):
+        return len(self.pending)
+
+    def submit(self, block, peer_id):
+        self.pending[block.id] = self.node.loop.create_future()
+        self.node.loop.create_task(self.process(block, peer_id))
+
+    def received(self, envelope):
+        """Hand over a transaction some block is waiting for; True if one was."""
+        if envelope.id not in self.waiting:
+            return False
+        future = self.waiting[envelope.id][0]
+        if not future.done():
+            future.set_result(envelope)
+        return True
+
+    async def process(self, block, peer_id):
+        done = self.pending[block.id]
+        try:
+            fetched = await self.fetch(block, peer_id)
+            await self.wait_parent(block)
+            if self.extends_tip(block):
+                txs = await self.verify(block, fetched)
+            # The tip may have moved while the signatures were verified
+            if self.extends_tip(block):
+                self.apply(block, txs)
+            else:
+                self.side_branch(block, fetched)
+            done.set_result(True)
+        except (BlockhainError, asyncio.TimeoutError) as error:
+            message = str(error) or 'Timed out validating block %s' % block.id
+            self.log.error(message)
+            done.set_result(False)
+            self.node.sync.rejected(block.id)
+            if self.node.server.peers.get(peer_id) is not None:
+                self.node.send_error(peer_id, message)
+        finally:
+            del self.pending[block.id]
+
+    def peers(self, first):
+        peers = [peer_id for (peer_id, peer) in self.node.server.peers.items() if peer.is_live()]
+        if first in peers:
+            peers.remove(first)
+            peers.insert(0, first)
+        return peers
+
+    async def fetch(self, block, peer_id):
+        """Collect the transactions of the block that are not confirmed yet.
+
+        They come from the mempool or the object store where possible. The
+        rest are announced to the request tracker as available from every
+        live peer, which spreads them over the least busy peers and moves on
+        to another peer when one does not answer.
+        """
+        node = self.node
+        local, missing = {}, []
+        for tx_id in block.txids:
+            if node.utxos.known(tx_id):
+                # Refused by check() once the block reaches it
+                continue
+            envelope = node.mempool.envelope(tx_id) or node.sync.take(tx_id) or self.coinbases.get(tx_id)
+            if envelope is None and node.db.get(tx_id):
+                envelope = Envelope(node.db.get(tx_id))
+            if envelope is None:
+                missing.append(tx_id)
+            else:
+                local[tx_id] = envelope
+        if not missing:
+            return local
+
+        futures = {}
+        for tx_id in missing:
+            if tx_id not in self.waiting:
+                self.waiting[tx_id] = [node.loop.create_future(), 0]
+            self.waiting[tx_id][1] += 1
+            futures[tx_id] = self.waiting[tx_id][0]
+        try:
+            peers = self.peers(peer_id)
+            for tx_id in missing:
+                node.requests.announce_all(peers, tx_id)
+            (_, unfinished) = await asyncio.wait(futures.values(), timeout=config.node.BLOCK_FETCH_TIMEOUT)
+            if unfinished:
+                raise BlockhainError('Could not fetch %d transactions of block %s' % (len(unfinished), block.id))
+            local.update((tx_id, future.result()) for (tx_id, future) in futures.items())
+            return local
+        finally:
+            for tx_id in missing:
+                self.waiting[tx_id][1] -= 1
+                if not self.waiting[tx_id][1]:
+                    del self.waiting[tx_id]
+
+    async def wait_parent(self, block):
+        if block.previd is not None and block.previd in self.pending:
+            await asyncio.wait_for(asyncio.shield(self.pending[block.previd]), config.node.BLOCK_PARENT_TIMEOUT)
+        if not block.check_parent(self.node.chain):
+            raise BlockhainError('Parent %s of block %s was not accepted' % (block.previd, block.id))
+
+    def extends_tip(self, block):
+        return block.previd == self.node.chain.tip
+
+    def check(self, block_id, txids, fetched):
+        """Check the unconfirmed transactions of a block in order against the UTxOSet.
+
+        Returns their envelopes and a DeferredVerifier holding the signatures
+        still to be verified.
+        """
+        view, verifier = UTxOView(self.node.utxos), DeferredVerifier()
+        txs = []
+        for (i, tx_id) in enumerate(txids):
+            if view.known(tx_id):
+                raise BlockhainError('Transaction %s of block %s is already confirmed' % (tx_id, block_id))
+            envelope = fetched.get(tx_id)
+            if envelope is None and self.node.db.get(tx_id):
+                envelope = Envelope(self.node.db.get(tx_id))
+            if envelope is None:
+                raise BlockhainError('Transaction %s of block %s is not available' % (tx_id, block_id))
+            coinbase = i == 0 and 'inputs' not in envelope.obj
+            verifier.owner = tx_id
+            try:
+                tx = Transaction(envelope, view, coinbase, verifier)
+            except (KeyError, TypeError):
+                raise BlockhainError('Transaction %s is malformed' % tx_id)
+            if not tx.valid:
+                raise BlockhainError('Transaction %s of block %s spends an unknown output' % (tx_id, block_id))
+            view.apply(tx_id, envelope.obj)
+            txs.append(envelope)
+        return (txs, verifier)
+
+    async def verify(self, block, fetched):
+        """Check the block's transactions against the tip and verify all their signatures in one batch.
+
+        Returns the envelopes of the transactions the block confirms.
+        """
+        (txs, verifier) = self.check(block.id, block.txids, fetched)
+        if not verifier.jobs:
+            return txs
+        bad = await asyncio.wait_for(
+            self.node.loop.run_in_executor(None, self.node.verifier.verify, verifier.jobs),
+            config.node.BLOCK_VERIFY_TIMEOUT
+        )
+        if bad is not None:
+            raise BlockhainError('Invalid signature in tx %s of block %s' % (verifier.owners[bad], block.id))
+        return txs
+
+    def store(self, txs):
+        node = self.node
+        for envelope in txs:
+            if not node.db.get(envelope.id):
+                node.db.set_raw(envelope.id, envelope.raw, envelope.obj)
+            node.validated.put(envelope.id, True)
+            self.coinbases.pop(envelope.id)
+
+    def apply(self, block, txs):
+        node = self.node
+        confirmed = [(envelope.id, envelope.obj) for envelope in txs]
+        with node.db.batch():
+            self.store(txs)
+            node.utxos.apply_block(block.id, confirmed)
+            node.mempool.confirm(confirmed)
+            stored = bool(node.db.get(block.id))
+            if not stored:
+                node.db.set_raw(block.id, block.envelope.raw, block.envelope.obj)
+            node.chain.add(block.id, block.envelope.obj)
+        self.accepted(block, txs, stored)
+
+    def accepted(self, block, txs, stored):
+        node = self.node
+        node.validated.put(block.id, True)
+        self.log.info('Accepted block %s confirming %d transactions' % (block.id, len(txs)))
+        # Blocks downloaded by the initial sync are old news to our peers
+        if not stored and not node.sync.active:
+            node.broadcast_object(block.id)
+        node.sync.accepted(block.id)
+        for envelope in txs:
+            node.adopt_orphans(envelope.id)
+        node.adopt_orphans(block.id)
+
+    def side_branch(self, block, fetched):
+        """Index a block that does not extend the tip, reorganising if it has the most work."""
+        node = self.node
+        work = node.chain.get(block.previd).work + block_work(block.envelope.obj['T'])
+        if work > node.chain.get(node.chain.tip).work:
+            self.reorganise(block, fetched)
+            return
+        with node.db.batch():
+            if not node.db.get(block.id):
+                node.db.set_raw(block.id, block.envelope.raw, block.envelope.obj)
+            node.chain.add(block.id, block.envelope.obj)
+        self.side.put(block.id, fetched)
+        self.log.info('Indexed block %s on a side branch at height %d' % (block.id, node.chain.height(block.id)))
+        node.sync.accepted(block.id)
+        node.adopt_orphans(block.id)
+
+    def reorganise(self, block, fetched):
+        """Switch the UTxOSet to the branch ending in `block`, then make it the tip.
+
+        Signatures are verified inline: reorganisations are rare and the
+        UTxOSet must not change under other blocks meanwhile.
+        """
+        node, chain, utxos = self.node, self.node.chain, self.node.utxos
+        branch = [(block.id, block.txids, fetched)]
+        fork_id = block.previd
+        while not chain.on_main_chain(fork_id):
+            branch.append((fork_id, node.db.get(fork_id)['txids'], self.side.get(fork_id, {})))
+            fork_id = chain.get(fork_id).parent
+        branch.reverse()
+        abandoned = chain.main_chain[chain.height(fork_id) + 1:]
+        if not utxos.can_undo(abandoned):
+            raise BlockhainError('Refusing to reorganise %d blocks deep to %s' % (len(abandoned), block.id))
+        self.log.info('Reorganising from %s to %s, %d blocks back to %s' % (chain.tip, block.id, len(abandoned), fork_id))
+
+        for block_id in reversed(abandoned):
+            utxos.undo_block(block_id)
+        applied = []
+        try:
+            for (block_id, txids, branch_fetched) in branch:
+                (txs, verifier) = self.check(block_id, txids, branch_fetched)
+                bad = node.verifier.verify(verifier.jobs) if verifier.jobs else None
+                if bad is not None:
+                    raise BlockhainError('Invalid signature in tx %s of block %s' % (verifier.owners[bad], block_id))
+                utxos.apply_block(block_id, [(envelope.id, envelope.obj) for envelope in txs])
+                applied.append((block_id, txs))
+        except BlockhainError:
+            for (block_id, _) in reversed(applied):
+                utxos.undo_block(block_id)
+            for block_id in abandoned:
+                utxos.apply_block(block_id, [(tx_id, node.db.get(tx_id)) for tx_id in node.db.get(block_id)['txids']])
+            raise
+
+        with node.db.batch():
+            for (block_id, txs) in applied:
+                self.store(txs)
+            stored = bool(node.db.get(block.id))
+            if not stored:
+                node.db.set_raw(block.id, block.envelope.raw, block.envelope.obj)
+            chain.add(block.id, block.envelope.obj)
+        for (block_id, _) in applied[:-1]:
+            self.side.pop(block_id)
+        node.mempool.reorganised(
+            [Envelope(node.db.get(tx_id)) for block_id in abandoned for tx_id in node.db.get(block_id)['txids']],
+            self.still_valid
+        )
+        self.accepted(block, applied[-1][1], stored)
+
+    def still_valid(self, envelope):
+        """Whether a transaction that was valid before a reorganisation still is.
+
+        Its signatures were verified when it was first accepted, so they are
+        only recorded here.
+        """
+        try:
+            return Transaction(envelope, self.node.mempool, False, DeferredVerifier()).valid
+        except (BlockhainError, KeyError, TypeError):
+            return False
@@ -0,0 +1,64 @@
+import asyncio
+import ipaddress
+import logging
+import socket
+import time
+from .cache import LRUCache
+
+
+class Resolver:
+    """Resolves peer host names on the event loop, caching the answers.
+
+    Lookups go through `loop.getaddrinfo`, which runs the system resolver in
+    the loop's executor, so a slow name server only delays that one peer.
+    Addresses are cached for `ttl` seconds and failures for `negative_ttl`,
+    concurrent lookups of the same name share one query, and literal IPv4
+    addresses never reach the resolver.
+    """
+    log = logging.getLogger('Resolver')
+
+    def __init__(self, loop, ttl, negative_ttl, timeout, max_entries):
+        self.loop = loop
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+
+        # Host name -> (address or None, expiry time)
+        self.cache = LRUCache(max_entries)
+        self.pending = {}
+
+    async def resolve(self, hostname):
+        try:
+            return str(ipaddress.IPv4Address(hostname))
+        except ValueError:
+            pass
+
+        entry = self.cache.get(hostname)
+        if entry is not None and entry[1] > time.monotonic():
+            if entry[0] is None:
+                raise socket.gaierror('Could not resolve %s (cached)' % hostname)
+            return entry[0]
+
+        if hostname not in self.pending:
+            self.pending[hostname] = self.loop.create_task(self.lookup(hostname))
+        address = await asyncio.shield(self.pending[hostname])
+        if address is None:
+            raise socket.gaierror('Could not resolve %s' % hostname)
+        return address
+
+    async def lookup(self, hostname):
+        try:
+            infos = await asyncio.wait_for(
+                self.loop.getaddrinfo(hostname, None, family=socket.AF_INET, type=socket.SOCK_STREAM),
+                self.timeout
+            )
+            address = infos[0][4][0]
+            self.cache.put(hostname, (address, time.monotonic() + self.ttl))
+            self.log.debug('Resolved %s to %s' % (hostname, address))
+            return address
+        except (OSError, UnicodeError, asyncio.TimeoutError, IndexError) as error:
+            self.log.debug('Could not resolve %s: %s' % (hostname, error))
+            self.cache.put(hostname, (None, time.monotonic() + self.negative_ttl))
+            return None
+        finally:
+            del self.pending[hostname]
@@ -0,0 +1,151 @@
+import collections
+import logging
+import time
+import config
+from .blockchain import parse_object
+from .exceptions import BlockhainError
+
+
+class InitialSync:
+    """Catches up with a chaintip the node does not know yet.
+
+    The protocol has no way to ask for a range of blocks, so the chain is
+    walked back one block at a time from the tip, asking every live peer, until
+    a known block is reached. Meanwhile the transactions of every block seen
+    so far are fetched from all peers at once, with at most IBD_WINDOW
+    requests in flight and IBD_MAX_PREFETCH transactions kept until the
+    pipeline takes them. Once the walk joins the chain, the blocks are handed
+    to the pipeline oldest first, which validates them in parent order.
+
+    While syncing, accepted blocks are not announced to peers; normal gossip
+    resumes once the tip is accepted. The duration of the last sync is kept in
+    `metrics` and logged. A walk that makes no progress for IBD_STALL_TIMEOUT
+    seconds is abandoned.
+    """
+    log = logging.getLogger('Sync')
+
+    def __init__(self, node):
+        self.node = node
+        self.active = False
+        self.metrics = {}
+        self.reset()
+
+    def reset(self):
+        self.target = None
+        self.next_id = None
+        self.walked = []
+        self.queue = collections.deque()
+        self.wanted, self.prefetched = set(), {}
+        self.released = set()
+        self.watchdog = None
+
+    def start(self, peer_id, tip_id):
+        """Start syncing towards `tip_id`; False if a sync is already running."""
+        if self.active:
+            return False
+        self.active = True
+        self.started = time.monotonic()
+        self.start_height = self.node.chain.height() or 0
+        self.target = tip_id
+        self.log.info('Syncing to chaintip %s from height %s' % (tip_id, self.node.chain.height()))
+        self.want(tip_id)
+        return True
+
+    def want(self, block_id):
+        self.next_id = block_id
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        self.watchdog = self.node.loop.call_later(config.node.IBD_STALL_TIMEOUT, self.stall, block_id)
+        self.node.requests.announce_all(self.peers(), block_id)
+
+    def peers(self):
+        return [peer_id for (peer_id, peer) in self.node.server.peers.items() if peer.is_live()]
+
+    def hold(self, block, peer_id):
+        """Take a block whose parent is unknown if it is the next one of the walk."""
+        if not self.active or block.id != self.next_id:
+            return False
+        self.walked.append((block, peer_id))
+        for tx_id in block.txids:
+            if tx_id not in self.prefetched and tx_id not in self.wanted and not self.node.has_object(tx_id):
+                self.queue.append(tx_id)
+        self.prefetch()
+
+        if block.check_parent(self.node.chain) or block.previd in self.node.pipeline:
+            self.release()
+        else:
+            self.want(block.previd)
+        return True
+
+    def prefetch(self):
+        peers = self.peers()
+        while self.queue and len(self.wanted) < config.node.IBD_WINDOW and (
+            len(self.wanted) + len(self.prefetched) < config.node.IBD_MAX_PREFETCH
+        ):
+            tx_id = self.queue.popleft()
+            self.wanted.add(tx_id)
+            self.node.requests.announce_all(peers, tx_id)
+
+    def received(self, envelope):
+        """Keep a prefetched transaction for the pipeline; True if it was one."""
+        if envelope.id not in self.wanted:
+            return False
+        self.wanted.discard(envelope.id)
+        self.prefetched[envelope.id] = envelope
+        self.prefetch()
+        return True
+
+    def take(self, tx_id):
+        """Return a prefetched transaction, or stop waiting for it if it has not arrived."""
+        self.wanted.discard(tx_id)
+        envelope = self.prefetched.pop(tx_id, None)
+        self.prefetch()
+        return envelope
+
+    def release(self):
+        """Hand the walked blocks to the pipeline, oldest first."""
+        self.log.info('Reached a known block, validating %d blocks' % len(self.walked))
+        self.next_id = None
+        if self.watchdog is not None:
+            self.watchdog.cancel()
+        for (block, peer_id) in reversed(self.walked):
+            self.released.add(block.id)
+            try:
+                parse_object(block.envelope, self.node, peer_id)
+            except BlockhainError as error_msg:
+                self.log.error(error_msg)
+        self.walked = []
+
+    def accepted(self, block_id):
+        self.released.discard(block_id)
+        if self.active and block_id == self.target:
+            self.finish()
+        elif self.active and block_id == self.next_id and self.walked:
+            # The walk reached a block that came in by another route, such as genesis
+            self.release()
+
+    def rejected(self, block_id):
+        if self.active and block_id in self.released:
+            self.log.error('Block %s of the synced chain was rejected, stopping sync' % block_id)
+            self.active = False
+            self.reset()
+
+    def finish(self):
+        elapsed = time.monotonic() - self.started
+        self.metrics = {
+            'tip': self.target,
+            'height': self.node.chain.height(),
+            'blocks': self.node.chain.height() - self.start_height,
+            'seconds': elapsed
+        }
+        self.log.info('Synced %d blocks to %s at height %d in %.2f s' % (
+            self.metrics['blocks'], self.target, self.metrics['height'], elapsed
+        ))
+        self.active = False
+        self.reset()
+
+    def stall(self, block_id):
+        if self.active and self.next_id == block_id:
+            self.log.error('No peer sent block %s in %d s, stopping sync' % (block_id, config.node.IBD_STALL_TIMEOUT))
+            self.active = False
+            self.reset()
@@ -0,0 +1,217 @@
+import collections
+import logging
+import os
+import struct
+
+
+class UTxOSet:
+    """Unspent transaction outputs, keyed by (txid, index).
+
+    Each output is kept as (pubkey bytes, value), so checking an input needs
+    neither a database read nor the whole funding transaction. Spent
+    outpoints are remembered as well, which makes telling a double spend
+    apart from a missing transaction O(1).
+
+    The set holds confirmed outputs only: it advances one accepted block at
+    a time and is written to a binary snapshot at `location` every
+    UTXO_SNAPSHOT_INTERVAL applied transactions and on close. The snapshot
+    records the last block applied; `replay` applies the main chain blocks
+    after it, so a missing or stale snapshot only costs a replay.
+
+    For the last `undo_depth` applied blocks the changes are remembered, so
+    a chain reorganisation can take them back with `undo_block`. Undo data
+    is not part of the snapshot.
+    """
+    log = logging.getLogger('UTxOSet')
+
+    MAGIC = b'PUT2'
+    HEADER = struct.Struct('>4s32sQQQ')
+    OUTPUT = struct.Struct('>32sI32sQ')
+    OUTPOINT = struct.Struct('>32sI')
+
+    def __init__(self, db, location, snapshot_interval=10000, undo_depth=100):
+        self.db = db
+        self.location = location
+        self.snapshot_interval = snapshot_interval
+        self.undo_depth = undo_depth
+
+        self.outputs = {}
+        self.spent = set()
+        self.applied = set()
+        self.tip = None
+        self.unsaved = 0
+        # Block id -> (parent id, [(tx id, [(outpoint, output, was spent)], [created outpoints])])
+        self.undo = collections.OrderedDict()
+
+        self.load()
+
+    def __len__(self):
+        return len(self.outputs)
+
+    def get(self, tx_id, index):
+        """Return (pubkey bytes, value) of an unspent output, or None."""
+        return self.outputs.get((tx_id, index))
+
+    def is_spent(self, tx_id, index):
+        return (tx_id, index) in self.spent
+
+    def known(self, tx_id):
+        return tx_id in self.applied
+
+    def apply(self, tx_id, tx):
+        """Spend the inputs of a confirmed transaction and add its outputs.
+
+        Returns what changed, for `undo_block`, or None if it was applied already.
+        """
+        if tx_id in self.applied:
+            return None
+        spent, created = [], []
+        for inp in tx.get('inputs', []):
+            outpoint = (inp['outpoint']['txid'], inp['outpoint']['index'])
+            spent.append((outpoint, self.outputs.pop(outpoint, None), outpoint in self.spent))
+            self.spent.add(outpoint)
+        for (index, output) in enumerate(tx['outputs']):
+            # A replayed child may have spent this output already
+            if (tx_id, index) not in self.spent:
+                self.outputs[(tx_id, index)] = (bytes.fromhex(output['pubkey']), output['value'])
+                created.append((tx_id, index))
+        self.applied.add(tx_id)
+        self.unsaved += 1
+        return (tx_id, spent, created)
+
+    def apply_block(self, block_id, txs):
+        """Apply the (id, transaction) pairs of a block extending the tip, in order."""
+        changes = [change for change in (self.apply(tx_id, tx) for (tx_id, tx) in txs) if change is not None]
+        self.undo[block_id] = (self.tip, changes)
+        while len(self.undo) > self.undo_depth:
+            self.undo.popitem(last=False)
+        self.tip = block_id
+
+    def can_undo(self, block_ids):
+        return all(block_id in self.undo for block_id in block_ids)
+
+    def undo_block(self, block_id):
+        """Take back the tip block `block_id`, making its parent the tip again."""
+        (parent_id, changes) = self.undo.pop(block_id)
+        for (tx_id, spent, created) in reversed(changes):
+            for outpoint in created:
+                del self.outputs[outpoint]
+            for (outpoint, output, was_spent) in reversed(spent):
+                if output is not None:
+                    self.outputs[outpoint] = output
+                if not was_spent:
+                    self.spent.discard(outpoint)
+            self.applied.discard(tx_id)
+            self.unsaved += 1
+        self.tip = parent_id
+
+    def replay(self, chain):
+        """Apply the main chain blocks of `chain` that the set does not cover yet."""
+        if self.tip is not None and not chain.on_main_chain(self.tip):
+            # Left behind by a reorganisation; its outputs cannot be taken back
+            self.log.info('Snapshot tip %s is not on the main chain, rebuilding' % self.tip)
+            self.outputs, self.spent, self.applied, self.tip = {}, set(), set(), None
+        start = 0 if self.tip is None else chain.height(self.tip) + 1
+        for block_id in chain.main_chain[start:]:
+            block = self.db.get(block_id)
+            for tx_id in block['txids']:
+                if tx_id in self.applied:
+                    # Only blocks accepted before confirmed transactions were refused
+                    self.log.error('Block %s confirms tx %s again, not applying it twice' % (block_id, tx_id))
+            self.apply_block(block_id, [
+                (tx_id, self.db.get(tx_id)) for tx_id in block['txids'] if tx_id not in self.applied
+            ])
+        if start < len(chain.main_chain):
+            self.log.info('Applied %d blocks missing from the snapshot' % (len(chain.main_chain) - start))
+
+    def maybe_snapshot(self):
+        if self.unsaved >= self.snapshot_interval:
+            self.snapshot()
+
+    def snapshot(self):
+        # The blocks applied so far must be on disk before a snapshot covering them
+        self.db.flush()
+        tmp_location = self.location + '.tmp'
+        with open(tmp_location, 'wb') as f:
+            tip = bytes(32) if self.tip is None else bytes.fromhex(self.tip)
+            f.write(self.HEADER.pack(self.MAGIC, tip, len(self.outputs), len(self.spent), len(self.applied)))
+            f.write(b''.join(
+                self.OUTPUT.pack(bytes.fromhex(tx_id), index, pubkey, value)
+                for ((tx_id, index), (pubkey, value)) in self.outputs.items()
+            ))
+            f.write(b''.join(self.OUTPOINT.pack(bytes.fromhex(tx_id), index) for (tx_id, index) in self.spent))
+            f.write(b''.join(bytes.fromhex(tx_id) for tx_id in self.applied))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_location, self.location)
+        self.unsaved = 0
+        self.log.debug('Saved %d unspent outputs to %s' % (len(self.outputs), self.location))
+
+    def load(self):
+        try:
+            with open(self.location, 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return
+        try:
+            (magic, tip, outputs, spent, applied) = self.HEADER.unpack_from(data)
+            if magic != self.MAGIC or len(data) != (
+                self.HEADER.size + outputs * self.OUTPUT.size + spent * self.OUTPOINT.size + applied * 32
+            ):
+                raise ValueError('Malformed snapshot')
+        except (struct.error, ValueError):
+            self.log.error('Ignoring unreadable snapshot %s' % self.location)
+            return
+
+        self.tip = None if tip == bytes(32) else tip.hex()
+        offset = self.HEADER.size
+        for (tx_id, index, pubkey, value) in self.OUTPUT.iter_unpack(data[offset:offset + outputs * self.OUTPUT.size]):
+            self.outputs[(tx_id.hex(), index)] = (pubkey, value)
+        offset += outputs * self.OUTPUT.size
+        for (tx_id, index) in self.OUTPOINT.iter_unpack(data[offset:offset + spent * self.OUTPOINT.size]):
+            self.spent.add((tx_id.hex(), index))
+        offset += spent * self.OUTPOINT.size
+        self.applied = {data[i:i + 32].hex() for i in range(offset, len(data), 32)}
+        self.log.info('Loaded %d unspent outputs from %s' % (len(self.outputs), self.location))
+
+    def close(self):
+        if self.unsaved:
+            self.snapshot()
+
+
+class UTxOView:
+    """Outputs created and spent by a block's transactions on top of a UTxOSet.
+
+    Transactions are checked against the view in block order, so one can
+    spend an output of an earlier transaction in the same block, and the set
+    itself is only changed once the whole block is valid.
+    """
+
+    def __init__(self, utxos):
+        self.utxos = utxos
+        self.outputs = {}
+        self.spent = set()
+        self.applied = set()
+
+    def get(self, tx_id, index):
+        outpoint = (tx_id, index)
+        if outpoint in self.spent:
+            return None
+        if outpoint in self.outputs:
+            return self.outputs[outpoint]
+        return self.utxos.get(tx_id, index)
+
+    def is_spent(self, tx_id, index):
+        return (tx_id, index) in self.spent or self.utxos.is_spent(tx_id, index)
+
+    def known(self, tx_id):
+        return tx_id in self.applied or self.utxos.known(tx_id)
+
+    def apply(self, tx_id, tx):
+        for inp in tx.get('inputs', []):
+            outpoint = (inp['outpoint']['txid'], inp['outpoint']['index'])
+            self.outputs.pop(outpoint, None)
+            self.spent.add(outpoint)
+        for (index, output) in enumerate(tx['outputs']):
+            self.outputs[(tx_id, index)] = (bytes.fromhex(output['pubkey']), output['value'])
+        self.applied.add(tx_id)
@@ -0,0 +1,76 @@
+import concurrent.futures
+import logging
+from nacl.signing import VerifyKey
+from nacl import exceptions as nacl_exceptions
+
+
+def verify_chunk(jobs):
+    """Check (pubkey, message, signature) jobs in order.
+
+    Returns the index of the first bad signature, or None if all are good.
+    """
+    for (i, (pubkey, message, signature)) in enumerate(jobs):
+        try:
+            VerifyKey(pubkey).verify(message, signature)
+        except (nacl_exceptions.BadSignatureError, ValueError, TypeError):
+            return i
+    return None
+
+
+class SignatureVerifier:
+    """Checks batches of ed25519 signatures on a pool of workers.
+
+    Jobs are split into chunks of `batch_size` and handed to a process pool,
+    or a thread pool since PyNaCl releases the GIL while verifying. Chunks are
+    collected in order, so the reported failure is always the first bad
+    signature of the batch, and the chunks after a failure are cancelled.
+    With no workers everything is verified inline.
+    """
+    log = logging.getLogger('Verifier')
+
+    def __init__(self, workers, mode='thread', batch_size=8):
+        self.batch_size = batch_size
+        if not workers:
+            self.executor = None
+        elif mode == 'process':
+            self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        elif mode == 'thread':
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='verify')
+        else:
+            raise ValueError('Unknown verification mode %s' % mode)
+
+    def verify(self, jobs):
+        """Return the index of the first bad signature in `jobs`, or None."""
+        if self.executor is None or len(jobs) <= self.batch_size:
+            return verify_chunk(jobs)
+
+        starts = range(0, len(jobs), self.batch_size)
+        futures = [self.executor.submit(verify_chunk, jobs[start:start + self.batch_size]) for start in starts]
+        for (start, future) in zip(starts, futures):
+            bad = future.result()
+            if bad is not None:
+                for pending in futures:
+                    pending.cancel()
+                return start + bad
+        return None
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class DeferredVerifier:
+    """Stands in for a SignatureVerifier and only records the jobs it is given.
+
+    Lets the signatures of many transactions be checked in a single batch;
+    `owner` is set to the transaction whose jobs are being recorded.
+    """
+
+    def __init__(self):
+        self.owner = None
+        self.jobs, self.owners = [], []
+
+    def verify(self, jobs):
+        self.jobs.extend(jobs)
+        self.owners.extend([self.owner] * len(jobs))
+        return None